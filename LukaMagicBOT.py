@@ -1,20 +1,30 @@
 import os
 import re
+import html
 import logging
+import logging.handlers
+import queue
+import time
 import asyncio
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
-from typing import Optional, List
+from typing import Optional, List, Tuple, Dict, Any, Callable, Awaitable, Final
 from contextlib import asynccontextmanager
+import functools
+import secrets
+import weakref
 import uvicorn
-import stripe
+import orjson
 from fastapi import FastAPI, Request, HTTPException
 from fastapi import Form
-from fastapi.responses import HTMLResponse, RedirectResponse
+from fastapi.responses import HTMLResponse, RedirectResponse, ORJSONResponse
 from starlette.middleware.sessions import SessionMiddleware
 import models
+from cache import TTLCache
+from ratelimit import AsyncTokenBucket
 from sqlalchemy import inspect
 from telegram.ext import (
+    AIORateLimiter,
     ApplicationBuilder,
     Application,
     CommandHandler,
@@ -25,6 +35,9 @@ from telegram.ext import (
     filters,
 )
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.constants import ParseMode
+from telegram.error import BadRequest
+from telegram.request import HTTPXRequest
 
 # Load environment variables from .env (for local runs)
 from dotenv import load_dotenv
@@ -34,22 +47,60 @@ load_dotenv()
 # FastAPI and Stripe
 
 # Configure logging
+# LOG_LEVEL=WARNING in production drops the per-update INFO lines
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
 )
+# httpx logs every Bot API request at INFO
+logging.getLogger("httpx").setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def _start_log_queue() -> None:
+    """Route root logging through a queue so handler I/O runs on a listener thread"""
+    global _log_listener
+    if _log_listener is not None:
+        return
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    for h in handlers:
+        root.removeHandler(h)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    _log_listener = logging.handlers.QueueListener(
+        log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+
+
+def _stop_log_queue() -> None:
+    """Flush pending records and restore the original root handlers"""
+    global _log_listener
+    if _log_listener is None:
+        return
+    _log_listener.stop()
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        if isinstance(h, logging.handlers.QueueHandler):
+            root.removeHandler(h)
+    for h in _log_listener.handlers:
+        root.addHandler(h)
+    _log_listener = None
+
 # Database
 try:
-    from db import SessionLocal, db_path_info, init_db
+    from db import SessionLocal, db_path_info, init_db, warm_connection_pool
     from crud import (
         get_active_by_email,
-        get_active_and_not_expired_by_email,
+        get_active_and_not_expired_by_email_cached,
+        invalidate_subscription_cache,
         mark_telegram_id,
-        get_recent_invite_for_email,
-        get_recent_invite_for_user,
+        get_recent_invite_for_email_or_user,
         log_invite,
+        cleanup_old_invite_logs,
+        cleanup_old_stripe_events,
     )
     from stripe_handlers import process_stripe_webhook_event
     DATABASE_AVAILABLE = True
@@ -62,6 +113,10 @@ except ImportError as e:
 # ======================
 TOKEN = os.getenv("BOT_TOKEN")
 PUBLIC_URL = os.getenv("PUBLIC_URL", "").rstrip("/")
+# Sent back by Telegram in X-Telegram-Bot-Api-Secret-Token on every webhook call
+TG_WEBHOOK_SECRET = os.getenv("TG_WEBHOOK_SECRET")
+# The only update types with handlers; everything else is never delivered
+ALLOWED_UPDATES: Final[List[str]] = [Update.MESSAGE, Update.CALLBACK_QUERY]
 ADMIN_USERNAME = os.getenv("ADMIN_USERNAME", "admin")
 ADMIN_PASSWORD = os.getenv("ADMIN_PASSWORD", "admin123")
 ADMIN_SECRET = os.getenv("ADMIN_SECRET", "change-this-admin-secret")
@@ -70,9 +125,34 @@ ADMIN_SECRET = os.getenv("ADMIN_SECRET", "change-this-admin-secret")
 STRIPE_SECRET_KEY = os.getenv(
     "STRIPE_SECRET_KEY") or os.getenv("STRIPE_API_KEY")
 STRIPE_WEBHOOK_SECRET = os.getenv("STRIPE_WEBHOOK_SECRET")
+# Stripe event payloads are a few KB; anything larger is rejected before reading
+STRIPE_WEBHOOK_MAX_BYTES = int(os.getenv("STRIPE_WEBHOOK_MAX_BYTES", "65536"))
+# Event ids already handled by this process; short-circuits Stripe's retry bursts
+_processed_stripe_events = TTLCache(maxsize=10_000, ttl=3600)
+# 0 (default): process inline and answer 500 on failure so Stripe retries.
+# 1: ack verified events at once and process them in the background; a failed
+#    or interrupted event is NOT redelivered by Stripe (resend from the Dashboard).
+STRIPE_WEBHOOK_ASYNC = os.getenv("STRIPE_WEBHOOK_ASYNC", "0") == "1"
+
+
+@functools.cache
+def _get_stripe():
+    """Import and configure the Stripe SDK on first use (keeps it off the cold-start path)"""
+    import stripe
+    if STRIPE_SECRET_KEY:
+        stripe.api_key = STRIPE_SECRET_KEY
+    return stripe
+
+
+def _construct_stripe_event(payload: bytes, sig_header: str):
+    """Validate the signature, then decode once with orjson (construct_event
+    would parse the body with the stdlib json module). CPU-bound: run off the loop."""
+    stripe = _get_stripe()
+    stripe.WebhookSignature.verify_header(
+        payload.decode("utf-8"), sig_header, STRIPE_WEBHOOK_SECRET, stripe.Webhook.DEFAULT_TOLERANCE
+    )
+    return stripe.Event.construct_from(orjson.loads(payload), stripe.api_key)
 
-if STRIPE_SECRET_KEY:
-    stripe.api_key = STRIPE_SECRET_KEY
 
 # Stripe links (static Payment Links used in the Plans button)
 STRIPE_MONTHLY_URL = "https://buy.stripe.com/8x29AVb3M4qn99xh0sawo00"
@@ -82,75 +162,239 @@ STRIPE_ANNUAL_URL = "https://buy.stripe.com/4gM3cx7RAg952L939Cawo02"
 # VIP invite fallback (primary static link)
 VIP_INVITE_LINK = os.getenv(
     "VIP_INVITE_LINK", "https://t.me/+PSEZYQQnodszYjYx")
+VIP_INVITE_LINK_HTML: Final[str] = html.escape(VIP_INVITE_LINK)
 
 # Placeholder for future one-time invites for multiple groups
 
 
-def _parse_group_ids(raw: str) -> List[int]:
-    ids: List[int] = []
-    for p in (raw or "").split(","):
-        p = p.strip()
-        if not p:
-            continue
-        try:
-            ids.append(int(p))
-        except ValueError:
-            pass
-    return ids
+# Telegram group ids are (usually negative) integers
+_GROUP_ID_RE = re.compile(r"-?[0-9]+")
+
+
+def _parse_group_ids(raw: str) -> Tuple[int, ...]:
+    return tuple(int(m.group()) for m in _GROUP_ID_RE.finditer(raw or ""))
 
 
-VIP_GROUP_IDS: List[int] = _parse_group_ids(os.getenv("VIP_GROUP_IDS", ""))
+VIP_GROUP_IDS: Tuple[int, ...] = _parse_group_ids(os.getenv("VIP_GROUP_IDS", ""))
+# Minimum gap between invite links for the same email or Telegram user
+INVITE_COOLDOWN_SECONDS = int(os.getenv("INVITE_COOLDOWN_SECONDS", "180"))
+# Dev only: hand out VIP_INVITE_LINK when one-time links cannot be created
+ALLOW_FALLBACK_INVITE = os.getenv("ALLOW_FALLBACK_INVITE", "0") == "1"
+
+# Telegram Bot API HTTP pool (connections to api.telegram.org are reused across handlers)
+TELEGRAM_POOL_SIZE = int(os.getenv("TELEGRAM_POOL_SIZE", "50"))
+TELEGRAM_POOL_TIMEOUT = float(os.getenv("TELEGRAM_POOL_TIMEOUT", "10"))
+# HTTP/2 multiplexes concurrent Bot API calls over one TLS connection ("1.1" to opt out)
+TELEGRAM_HTTP_VERSION = os.getenv("TELEGRAM_HTTP_VERSION", "2")
+# Max updates handled at the same time (different users no longer wait on each other)
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "256"))
 
 # Global application instance
 application: Optional[Application] = None
 
+# Strong references to fire-and-forget tasks (the loop only keeps weak ones)
+_background_tasks: set = set()
+
+
+def _on_background_task_done(task: asyncio.Task) -> None:
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning("Background task failed: %s", task.exception())
+
+
+def _fire_and_forget(coro) -> asyncio.Task:
+    """Schedule a coroutine without awaiting it; failures are logged, not lost"""
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_on_background_task_done)
+    return task
+
+
+# Telegram flood limits: ~30 messages/s per bot (AIORateLimiter on the Application
+# covers every call), ~1/s per chat for edits (short bursts allowed).
+# Idle chats' buckets expire, which bounds memory
+_chat_send_buckets = TTLCache(maxsize=10_000, ttl=60)
+
+
+def _chat_bucket(chat_id: int) -> AsyncTokenBucket:
+    bucket = _chat_send_buckets.get(chat_id)
+    if bucket is None:
+        bucket = AsyncTokenBucket(rate=1, capacity=3)
+    # Re-set on every use so active chats keep their bucket
+    _chat_send_buckets.set(chat_id, bucket)
+    return bucket
+
+
+# (chat_id, message_id) -> hash of the last text/markup this process put there.
+# Lets double taps skip an edit Telegram would reject with "message is not modified"
+_last_edits = TTLCache(maxsize=10_000, ttl=3600)
+
+
+async def _edit_callback_message(query, **kwargs):
+    """query.edit_message_text paced by the chat's bucket; a no-op if the content is unchanged"""
+    message = query.message
+    if message is None:
+        return await query.edit_message_text(**kwargs)
+    key = (message.chat_id, message.message_id)
+    content = hash((kwargs.get("text"), kwargs.get("parse_mode"), kwargs.get("reply_markup")))
+    if _last_edits.get(key) == content:
+        return None
+    await _chat_bucket(message.chat_id).acquire()
+    result = await query.edit_message_text(**kwargs)
+    _last_edits.set(key, content)
+    return result
+
+
+def _ack_callback(update: Update) -> None:
+    """Answer the callback query right away so the client's loading clock clears"""
+    if update.callback_query:
+        _fire_and_forget(update.callback_query.answer())
+
 # ======================
 # Bot texts
 # ======================
-HOW_IT_WORKS_TEXT = (
-    "ℹ️ **How It Works**\n\n"
-    "**1️⃣ Choose Your Plan**\n"
-    "Tap on **🌟 Plans** and pick Monthly, Quarterly, or Annual.\n\n"
-    "**2️⃣ Complete Your Payment (Stripe)**\n"
+HOW_IT_WORKS_TEXT: Final[str] = (
+    "ℹ️ <b>How It Works</b>\n\n"
+    "<b>1️⃣ Choose Your Plan</b>\n"
+    "Tap on <b>🌟 Plans</b> and pick Monthly, Quarterly, or Annual.\n\n"
+    "<b>2️⃣ Complete Your Payment (Stripe)</b>\n"
     "Use your email normally.\n\n"
-    "**3️⃣ Unlock Your VIP Access**\n"
-    "Come back to this bot and tap **🔓 Unlock Access**.\n"
-    "Enter the **email** you used in Stripe. If active, you'll receive your VIP invite(s).\n\n"
-    "💡 Tip: If you have any issues, tap **🆘 Support**."
+    "<b>3️⃣ Unlock Your VIP Access</b>\n"
+    "Come back to this bot and tap <b>🔓 Unlock Access</b>.\n"
+    "Enter the <b>email</b> you used in Stripe. If active, you'll receive your VIP invite(s).\n\n"
+    "💡 Tip: If you have any issues, tap <b>🆘 Support</b>."
+)
+
+PLANS_TEXT: Final[str] = (
+    "🌟 <b>Luka Magic Europe – Plans</b>\n\n"
+    "💶 <s>€50</s> → <b>€30</b>\n"
+    "<i>€30 / month – 40% off</i>\n\n"
+    "📊 <s>€150</s> → <b>€80</b>\n"
+    "<i>€26.67 / month – 46% off</i>\n\n"
+    "🏆 <s>€600</s> → <b>€270</b>\n"
+    "<i>€22.50 / month – 55% off</i>"
+)
+
+UNLOCK_PROMPT_TEXT: Final[str] = (
+    "🔓 <b>Unlock Access</b>\n\n"
+    "📧 <b>Type the email</b> you used on Stripe to pay.\n\n"
+    "✨ After verifying your subscription, you will receive:\n"
+    "• Your subscription details\n"
+    "• A temporary link to the VIP group\n\n"
+    "💡 Please type only your email below:"
+)
+
+WELCOME_TEXT: Final[str] = "✅ Welcome! Please choose an option:"
+
+# Unlock replies: static skeletons filled with format_map (values must be HTML-escaped)
+SUBSCRIPTION_FOUND_TEMPLATE: Final[str] = (
+    "✅ <b>Subscription Found!</b>\n\n"
+    "📧 <b>Email:</b> {email}\n"
+    "📋 <b>Plan:</b> {plan}\n"
+    "📅 <b>Status:</b> {status}\n"
+    "⏰ <b>Expires at:</b> {expires_at}\n\n"
+    "🔄 Generating your access link..."
+)
+ACCESS_GRANTED_LINKS_TEMPLATE: Final[str] = (
+    "🎉 <b>Access Granted!</b>\n\n"
+    "🔗 <b>Your VIP links ({link_type}):</b>\n{links}\n\n"
+    "📊 <b>Total:</b> {count} VIP groups\n\n"
+    "⏰ <b>Important:</b>\n"
+    "• {expiry}\n"
+    "• {usage}\n"
+    "• Use them to join the VIP groups\n\n"
+    "🎯 Welcome to VIP!"
+)
+ACCESS_GRANTED_LINK_TEMPLATE: Final[str] = (
+    "🎉 <b>Access Granted!</b>\n\n"
+    "🔗 <b>Your VIP link ({link_type}):</b>\n{link}\n\n"
+    "⏰ <b>Important:</b>\n"
+    "• {expiry}\n"
+    "• {usage}\n"
+    "• Use it to join the VIP group\n\n"
+    "🎯 Welcome to VIP!"
 )
 
+# ======================
+# Bot keyboards (built once; PTB never mutates markups)
+# ======================
+HOME_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🆘 Support", url="https://t.me/Sthefano_p"),
+        InlineKeyboardButton("🆔 My ID", callback_data="myid.show"),
+    ],
+    [
+        InlineKeyboardButton(
+            "🔓 Unlock Access", callback_data="unlock.access"),
+        InlineKeyboardButton("🌟 Plans", callback_data="plans.open")
+    ],
+    [
+        InlineKeyboardButton(
+            "🎁 Free Group", url="https://t.me/lukaeurope77"),
+        InlineKeyboardButton("ℹ️ How It Works", callback_data="howitworks")
+    ],
+    [
+        InlineKeyboardButton(
+            "🌐 Sales Website", url="https://lukamagiceurope.com")
+    ]
+])
+
+PLANS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💶 Monthly – €30", url=STRIPE_MONTHLY_URL)],
+    [InlineKeyboardButton("📊 Quarterly – €80", url=STRIPE_QUARTERLY_URL)],
+    [InlineKeyboardButton("🏆 Annual – €270", url=STRIPE_ANNUAL_URL)],
+    [InlineKeyboardButton("⬅️ Back", callback_data="home.back")]
+])
+
+# Single "Back to home" button (How It Works, Unlock Access, My ID)
+BACK_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("⬅️ Back", callback_data="home.back")]])
+
+EXPIRED_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton("🌟 Plans", callback_data="plans.open")]])
+
 # ======================
 # Bot UI
 # ======================
 
 
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [
-            InlineKeyboardButton("🆘 Support", url="https://t.me/Sthefano_p"),
-            InlineKeyboardButton("🆔 My ID", callback_data="myid.show"),
-        ],
-        [
-            InlineKeyboardButton(
-                "🔓 Unlock Access", callback_data="unlock.access"),
-            InlineKeyboardButton("🌟 Plans", callback_data="plans.open")
-        ],
-        [
-            InlineKeyboardButton(
-                "🎁 Free Group", url="https://t.me/lukaeurope77"),
-            InlineKeyboardButton("ℹ️ How It Works", callback_data="howitworks")
-        ],
-        [
-            InlineKeyboardButton(
-                "🌐 Sales Website", url="https://lukamagiceurope.com")
-        ]
-    ]
+# chat_id -> lock; entries disappear once no handler holds or awaits the lock
+_chat_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _per_chat_serialized(handler):
+    """
+    Run the handler under its chat's lock: chats proceed concurrently, while
+    updates from one chat keep their order (e.g. Plans then Back).
+    Callback queries are answered before waiting for the lock.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        _ack_callback(update)
+        chat = update.effective_chat
+        if chat is None:
+            return await handler(update, context)
+        lock = _chat_locks.get(chat.id)
+        if lock is None:
+            lock = asyncio.Lock()
+            _chat_locks[chat.id] = lock
+        async with lock:
+            return await handler(update, context)
+    return wrapper
+
+
+async def _send_home(update: Update):
     await update.effective_message.reply_text(
-        "✅ Welcome! Please choose an option:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        WELCOME_TEXT,
+        reply_markup=HOME_MARKUP
     )
 
 
+@_per_chat_serialized
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _send_home(update)
+
+
 async def cmd_myid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     await update.effective_message.reply_text(
@@ -164,82 +408,125 @@ async def groupid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     chat_title = update.effective_chat.title or "Private Chat"
     await update.effective_message.reply_text(
-        "📌 Group Name: {}\n🆔 Group ID: `{}`".format(chat_title, chat_id),
-        parse_mode="Markdown"
+        "📌 Group Name: {}\n🆔 Group ID: <code>{}</code>".format(html.escape(chat_title), chat_id),
+        parse_mode=ParseMode.HTML
     )
 
 # (removed) test_invite command to avoid any shortcut for generating links
 
 
+@_per_chat_serialized
 async def open_plans(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    text = (
-        "🌟 <b>Luka Magic Europe – Plans</b>\n\n"
-        "💶 <s>€50</s> → <b>€30</b>\n"
-        "<i>€30 / month – 40% off</i>\n\n"
-        "📊 <s>€150</s> → <b>€80</b>\n"
-        "<i>€26.67 / month – 46% off</i>\n\n"
-        "🏆 <s>€600</s> → <b>€270</b>\n"
-        "<i>€22.50 / month – 55% off</i>"
-    )
-    keyboard = [
-        [InlineKeyboardButton("💶 Monthly – €30", url=STRIPE_MONTHLY_URL)],
-        [InlineKeyboardButton("📊 Quarterly – €80", url=STRIPE_QUARTERLY_URL)],
-        [InlineKeyboardButton("🏆 Annual – €270", url=STRIPE_ANNUAL_URL)],
-        [InlineKeyboardButton("⬅️ Back", callback_data="home.back")]
-    ]
-    await query.edit_message_text(
-        text=text,
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="HTML"
+    await _edit_callback_message(
+        query,
+        text=PLANS_TEXT,
+        reply_markup=PLANS_MARKUP,
+        parse_mode=ParseMode.HTML
     )
 
 
+@_per_chat_serialized
 async def back_to_home(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    await start(update, context)
+    # Edit the current message in place instead of sending a new one
+    try:
+        await _edit_callback_message(
+            update.callback_query,
+            text=WELCOME_TEXT,
+            reply_markup=HOME_MARKUP
+        )
+    except BadRequest as e:
+        if "not modified" in str(e).lower():
+            return
+        # Message too old / deleted / not editable: fall back to a new home message
+        logger.info("Back edit failed (%s); sending a new home message", e)
+        await _send_home(update)
 
 
+@_per_chat_serialized
 async def show_how_it_works(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
-    await query.answer()
-    await query.edit_message_text(
+    await _edit_callback_message(
+        query,
         text=HOW_IT_WORKS_TEXT,
-        parse_mode="Markdown",
-        reply_markup=InlineKeyboardMarkup(
-            [[InlineKeyboardButton("⬅️ Back", callback_data="home.back")]])
+        parse_mode=ParseMode.HTML,
+        reply_markup=BACK_MARKUP
     )
 
 # ======================
 # Unlock Access (basic flow)
 
 
+async def _ack_only(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Answer a repeated Unlock Access tap while the first one is still running"""
+    _ack_callback(update)
+
+
 async def unlock_access_prompt(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [[InlineKeyboardButton("⬅️ Back", callback_data="home.back")]]
-    await update.callback_query.edit_message_text(
-        text=(
-            "🔓 **Unlock Access**\n\n"
-            "📧 **Type the email** you used on Stripe to pay.\n\n"
-            "✨ After verifying your subscription, you will receive:\n"
-            "• Your subscription details\n"
-            "• A temporary link to the VIP group\n\n"
-            "💡 Please type only your email below:"
-        ),
-        reply_markup=InlineKeyboardMarkup(keyboard),
-        parse_mode="Markdown"
+    # While this block=False entry point runs, the conversation is pending and only
+    # ConversationHandler.WAITING handlers match; a repeated tap lands in _ack_only
+    _ack_callback(update)
+    await _edit_callback_message(
+        update.callback_query,
+        text=UNLOCK_PROMPT_TEXT,
+        reply_markup=BACK_MARKUP,
+        parse_mode=ParseMode.HTML
     )
     return ASK_EMAIL
 # ======================
 
 ASK_EMAIL = 10
-EMAIL_REGEX = re.compile(r"^[^\s@]+@[^@]+\.[^\s@]+$")
+EMAIL_MAX_LENGTH = 254  # RFC 5321 limit
+UNLOCK_CB_RE = re.compile(r"^unlock\.access$")
+HOME_BACK_CB_RE = re.compile(r"^home\.back$")
+
+
+# What \s matched in the old re.ASCII pattern; Unicode spaces are not rejected
+_ASCII_WHITESPACE = frozenset(" \t\n\r\f\v")
+
+
+def _valid_email(email: str) -> bool:
+    """local@domain.tld: no ASCII whitespace, a single '@', a dot inside the domain"""
+    if len(email) > EMAIL_MAX_LENGTH or not _ASCII_WHITESPACE.isdisjoint(email):
+        return False
+    local, at, domain = email.rpartition("@")
+    if not at or not local or "@" in local:
+        return False
+    dot = domain.find(".", 1)
+    return dot != -1 and dot < len(domain) - 1
+
+
+# email -> pending lookup task; concurrent unlocks for the same email share one query
+_inflight_subscription_lookups: Dict[str, asyncio.Task] = {}
+
+
+def _lookup_subscription_sync(email: str):
+    # Own session: the shared lookup must not depend on any one caller's session
+    with SessionLocal() as db:
+        return get_active_and_not_expired_by_email_cached(db, email)
 
 
+async def _lookup_subscription(email: str):
+    """Cached subscription lookup with in-flight de-duplication (duplicate clicks).
+    The lookup runs in its own task, so cancelling one caller never cancels the others."""
+    task = _inflight_subscription_lookups.get(email)
+    if task is None:
+        task = asyncio.create_task(asyncio.to_thread(_lookup_subscription_sync, email))
+        _inflight_subscription_lookups[email] = task
+
+        def _forget(t: asyncio.Task) -> None:
+            if _inflight_subscription_lookups.get(email) is t:
+                del _inflight_subscription_lookups[email]
+            if not t.cancelled():
+                t.exception()  # mark retrieved even if every waiter was cancelled
+        task.add_done_callback(_forget)
+    return await asyncio.shield(task)
+
+
+@_per_chat_serialized
 async def unlock_access_check_email(update: Update, context: ContextTypes.DEFAULT_TYPE):
     email = (update.effective_message.text or "").strip().lower()
-    if not EMAIL_REGEX.match(email):
+    if not _valid_email(email):
         await update.effective_message.reply_text(
             "⚠️ That doesn't look like a valid email. Try again, please."
         )
@@ -247,64 +534,77 @@ async def unlock_access_check_email(update: Update, context: ContextTypes.DEFAUL
 
     if not DATABASE_AVAILABLE:
         await update.effective_message.reply_text(
-            f"✅ Thanks! We received **{email}**. Database integration is being set up.",
-            parse_mode="Markdown"
+            f"✅ Thanks! We received <b>{html.escape(email)}</b>. Database integration is being set up.",
+            parse_mode=ParseMode.HTML
         )
         return ConversationHandler.END
 
     with SessionLocal() as db:
         logger.info("DB URL runtime: %s", db_path_info(db))
         try:
-            subscription = get_active_and_not_expired_by_email(db, email)
+            subscription = await _lookup_subscription(email)
             if subscription:
                 user_id = str(update.effective_user.id)
                 logger.info(
                     "Trying to link telegram_user_id %s to email %s", user_id, email)
-                success = mark_telegram_id(db, email, user_id)
+                success = await asyncio.to_thread(mark_telegram_id, db, email, user_id)
                 logger.info("Result of mark_telegram_id: %s", success)
                 if success:
                     # FIRST MESSAGE: Subscription details
-                    subscription_info = (
-                        "✅ **Subscription Found!**\n\n"
-                        f"📧 **Email:** {subscription.email}\n"
-                        f"📋 **Plan:** {subscription.plan_type.title()}\n"
-                        f"📅 **Status:** {subscription.status.title()}\n"
-                        f"⏰ **Expires at:** {subscription.expires_at.strftime('%d/%m/%Y') if subscription.expires_at else 'N/A'}\n\n"
-                        "🔄 Generating your access link..."
-                    )
-                    await update.effective_message.reply_text(
-                        subscription_info,
-                        parse_mode="Markdown"
-                    )
-                    
-                    # Pequeno delay para melhor UX
-                    await asyncio.sleep(1.5)
-                    
+                    subscription_info = SUBSCRIPTION_FOUND_TEMPLATE.format_map({
+                        "email": html.escape(subscription.email),
+                        "plan": html.escape(subscription.plan_type.title()),
+                        "status": html.escape(subscription.status.title()),
+                        "expires_at": subscription.expires_at.strftime('%d/%m/%Y') if subscription.expires_at else 'N/A',
+                    })
+
+                    async def send_subscription_info():
+                        await update.effective_message.reply_text(
+                            subscription_info,
+                            parse_mode=ParseMode.HTML
+                        )
+                        # Pequeno delay para melhor UX
+                        await asyncio.sleep(1.5)
+
                     # SECOND MESSAGE: Temporary link (with cooldown control)
                     try:
-                        logger.info(f"🔗 Generating invite link for user {user_id}")
-                        cooldown_seconds = int(os.getenv("INVITE_COOLDOWN_SECONDS", "180"))
-                        # Checar por email E por telegram_user_id
-                        recent_email = get_recent_invite_for_email(db, email, cooldown_seconds)
-                        recent_user = get_recent_invite_for_user(db, user_id, cooldown_seconds)
-                        recent = recent_email or recent_user
+                        cooldown_seconds = INVITE_COOLDOWN_SECONDS
+                        # One clock read for the cooldown math and the logged expiry
+                        now = datetime.utcnow()
+                        # Checar por email E por telegram_user_id (uma única query)
+                        recent = await asyncio.to_thread(
+                            get_recent_invite_for_email_or_user, db, email, user_id, cooldown_seconds)
                         if recent:
+                            await send_subscription_info()
                             # Em vez de reutilizar, avisar cooldown restante
-                            now = datetime.utcnow()
                             elapsed = (now - recent.created_at).total_seconds()
                             remaining = max(0, int(cooldown_seconds - elapsed))
                             await update.effective_message.reply_text(
                                 f"⏳ Please wait {remaining} seconds before requesting a new invite link.")
                             return ConversationHandler.END
-                        
-                        # Generate invite link
-                        invite_link = await create_one_time_invite_link(
-                            context.bot, update.effective_user.id)
+
+                        # Release the pooled connection across the Telegram round-trips below.
+                        # close() (unlike rollback()) expunges without expiring loaded objects;
+                        # the session stays usable and log_invite checks a connection out again
+                        await asyncio.to_thread(db.close)
+
+                        # Generate invite link while the details message (and its delay) goes out
+                        logger.info("🔗 Generating invite link for user %s", user_id)
+                        invite_task = asyncio.create_task(
+                            create_one_time_invite_link(context.bot, update.effective_user.id))
+                        try:
+                            # Details always go out before the link (or the error reply)
+                            await send_subscription_info()
+                        except BaseException:
+                            invite_task.cancel()
+                            raise
+                        invite_link = await invite_task
                         is_temporary = invite_link != VIP_INVITE_LINK
-                        expires_at = (datetime.utcnow() + timedelta(hours=1)) if is_temporary else None
+                        expires_at = (now + timedelta(hours=1)) if is_temporary else None
                         
                         # Log the invite
-                        log_invite(
+                        await asyncio.to_thread(
+                            log_invite,
                             db,
                             email=email,
                             telegram_user_id=user_id,
@@ -318,35 +618,30 @@ async def unlock_access_check_email(update: Update, context: ContextTypes.DEFAUL
                         link_type = "temporary (1 use)" if is_temporary else "static"
                         
                         # Format message for multiple links
-                        if "\n" in invite_link:
+                        links = invite_link.split("\n")
+                        usage = "Valid for one person only" if is_temporary else "Can be used multiple times"
+                        if len(links) > 1:
                             # Multiple links (one per line)
-                            links_text = "\n".join([f"🔗 {link}" for link in invite_link.split("\n")])
-                            links_count = len(invite_link.split("\n"))
-                            await update.effective_message.reply_text(
-                                f"🎉 **Access Granted!**\n\n"
-                                f"🔗 **Your VIP links ({link_type}):**\n{links_text}\n\n"
-                                f"📊 **Total:** {links_count} VIP groups\n\n"
-                                "⏰ **Important:**\n"
-                                f"• {'These links expire in 1 hour' if is_temporary else 'Permanent group links'}\n"
-                                f"• {'Valid for one person only' if is_temporary else 'Can be used multiple times'}\n"
-                                "• Use them to join the VIP groups\n\n"
-                                "🎯 Welcome to VIP!",
-                                parse_mode="Markdown",
-                                disable_web_page_preview=True
-                            )
+                            granted_text = ACCESS_GRANTED_LINKS_TEMPLATE.format_map({
+                                "link_type": link_type,
+                                "links": "\n".join([f"🔗 {html.escape(link)}" for link in links]),
+                                "count": len(links),
+                                "expiry": "These links expire in 1 hour" if is_temporary else "Permanent group links",
+                                "usage": usage,
+                            })
                         else:
                             # Single link (fallback)
-                            await update.effective_message.reply_text(
-                                "🎉 **Access Granted!**\n\n"
-                                f"🔗 **Your VIP link ({link_type}):**\n{invite_link}\n\n"
-                                "⏰ **Important:**\n"
-                                f"• {'This link expires in 1 hour' if is_temporary else 'Permanent group link'}\n"
-                                f"• {'Valid for one person only' if is_temporary else 'Can be used multiple times'}\n"
-                                "• Use it to join the VIP group\n\n"
-                                "🎯 Welcome to VIP!",
-                                parse_mode="Markdown",
-                                disable_web_page_preview=True
-                            )
+                            granted_text = ACCESS_GRANTED_LINK_TEMPLATE.format_map({
+                                "link_type": link_type,
+                                "link": html.escape(invite_link) if is_temporary else VIP_INVITE_LINK_HTML,
+                                "expiry": "This link expires in 1 hour" if is_temporary else "Permanent group link",
+                                "usage": usage,
+                            })
+                        await update.effective_message.reply_text(
+                            granted_text,
+                            parse_mode=ParseMode.HTML,
+                            disable_web_page_preview=True
+                        )
                         logger.info(
                             "✅ VIP access granted to user %s for email %s (link type: %s)", 
                             user_id, email, link_type)
@@ -365,15 +660,14 @@ async def unlock_access_check_email(update: Update, context: ContextTypes.DEFAUL
                 # Check if there is a subscription but expired
                 any_sub = None
                 try:
-                    any_sub = get_active_by_email(db, email)
+                    any_sub = await asyncio.to_thread(get_active_by_email, db, email)
                 except Exception:
                     any_sub = None
                 if any_sub and any_sub.expires_at and any_sub.expires_at < datetime.utcnow():
                     # expired
-                    keyboard = [[InlineKeyboardButton("🌟 Plans", callback_data="plans.open")]]
                     await update.effective_message.reply_text(
                         "❌ Your subscription has expired. Please renew your plan to continue. 💳",
-                        reply_markup=InlineKeyboardMarkup(keyboard)
+                        reply_markup=EXPIRED_MARKUP
                     )
                 else:
                     await update.effective_message.reply_text(
@@ -417,51 +711,56 @@ async def create_one_time_invite_link(bot, user_id: int, ttl_seconds: int = 3600
     Returns:
         Invite URLs (one-time or fallback)
     """
-    logger.info(f"Starting invite link creation for user {user_id}")
-    logger.info(f"Configured VIP_GROUP_IDS: {VIP_GROUP_IDS}")
-    logger.info(f"Fallback VIP_INVITE_LINK: {VIP_INVITE_LINK}")
+    logger.info("Starting invite link creation for user %s", user_id)
+    logger.debug("Configured VIP_GROUP_IDS: %s", VIP_GROUP_IDS)
+    logger.debug("Fallback VIP_INVITE_LINK: %s", VIP_INVITE_LINK)
     
-    allow_fallback = os.getenv("ALLOW_FALLBACK_INVITE", "0") == "1"
     if not VIP_GROUP_IDS:
-        if allow_fallback:
+        if ALLOW_FALLBACK_INVITE:
             logger.warning("No VIP_GROUP_IDS configured, using fallback link (dev mode)")
-            logger.info(f"Returning fallback link: {VIP_INVITE_LINK}")
+            logger.info("Returning fallback link: %s", VIP_INVITE_LINK)
             return VIP_INVITE_LINK
         logger.error("VIP group configuration missing and fallback disabled")
         raise RuntimeError("VIP group configuration is missing. Please contact support.")
 
     # Use epoch timestamp and disable join requests (1 hour, 1 use)
-    expire_epoch = int((datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)).timestamp())
-    logger.info(f"Links will expire at epoch: {expire_epoch}")
+    expire_epoch = int(time.time()) + ttl_seconds
+    logger.debug("Links will expire at epoch: %s", expire_epoch)
 
     invite_links = []
-    
-    # Generate links for all groups
-    for group_id in VIP_GROUP_IDS:
-        try:
-            logger.info(f"Trying to create invite for group: {group_id}")
-            
-            invite_link = await bot.create_chat_invite_link(
+
+    invite_name = f"VIP Access - User {user_id}"
+
+    # Generate links for all groups concurrently (one Telegram round-trip total)
+    results = await asyncio.gather(
+        *(
+            bot.create_chat_invite_link(
                 chat_id=group_id,
                 expire_date=expire_epoch,
                 member_limit=member_limit,
                 creates_join_request=False,
-                name=f"VIP Access - User {user_id}"
+                name=invite_name
             )
+            for group_id in VIP_GROUP_IDS
+        ),
+        return_exceptions=True,
+    )
 
-            invite_links.append(invite_link.invite_link)
-            logger.info(
-                "✅ Created one-time invite for user %s in group %s: %s",
-                user_id, group_id, invite_link.invite_link)
-
-        except Exception as e:
-            error_msg = str(e)
+    for group_id, result in zip(VIP_GROUP_IDS, results):
+        if isinstance(result, Exception):
+            error_msg = str(result)
             if "not enough rights" in error_msg.lower() or "forbidden" in error_msg.lower():
                 logger.error("❌ Bot lacks admin permissions in group %s: %s", group_id, error_msg)
             else:
                 logger.error("❌ Error creating invite link for user %s in group %s: %s",
-                             user_id, group_id, e, exc_info=True)
+                             user_id, group_id, result, exc_info=result)
             # Continue with other groups even if one fails
+            continue
+
+        invite_links.append(result.invite_link)
+        logger.info(
+            "✅ Created one-time invite for user %s in group %s: %s",
+            user_id, group_id, result.invite_link)
 
     if invite_links:
         # Return all links separated by newlines
@@ -470,9 +769,9 @@ async def create_one_time_invite_link(bot, user_id: int, ttl_seconds: int = 3600
         return all_links
     else:
         # If no links were created, use fallback
-        if allow_fallback:
+        if ALLOW_FALLBACK_INVITE:
             logger.warning("🔄 Using fallback VIP link due to errors (dev mode)")
-            logger.info(f"Returning fallback link: {VIP_INVITE_LINK}")
+            logger.info("Returning fallback link: %s", VIP_INVITE_LINK)
             return VIP_INVITE_LINK
         raise RuntimeError("Failed to create invite links for any VIP group. Please contact support.")
 
@@ -481,42 +780,27 @@ async def create_one_time_invite_link(bot, user_id: int, ttl_seconds: int = 3600
 # ======================
 
 
-async def button_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    data = update.callback_query.data if update.callback_query else None
-    if data == "plans.open":
-        await open_plans(update, context)
-        return
-    if data == "home.back":
-        await back_to_home(update, context)
-        return
-    if data == "howitworks":
-        await show_how_it_works(update, context)
-        return
-    if data == "unlock.access":
-        await unlock_access_prompt(update, context)
-        return
-    if data == "myid.show":
-        try:
-            await update.callback_query.answer()
-        except Exception as e:
-            logger.warning("CallbackQuery answer failed: %s", e)
-        uid = update.effective_user.id
-        await update.callback_query.edit_message_text(
-            text=f"🆔 Your Telegram ID is: <code>{uid}</code>",
-            parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("⬅️ Back", callback_data="home.back")]])
-        )
-        return
-    # fallback
-    try:
-        await update.callback_query.answer()
-    except Exception as e:
-        logger.warning("CallbackQuery answer failed: %s", e)
-    await update.callback_query.edit_message_text(
-        text="✅ You clicked: {}".format(data)
+@_per_chat_serialized
+async def show_my_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    await _edit_callback_message(
+        update.callback_query,
+        text=f"🆔 Your Telegram ID is: <code>{uid}</code>",
+        parse_mode=ParseMode.HTML,
+        reply_markup=BACK_MARKUP
     )
 
+
+# callback_data -> handler; setup_handlers registers one exact-match handler per entry
+CALLBACK_ROUTES: Dict[str, Callable[[Update, ContextTypes.DEFAULT_TYPE], Awaitable[Any]]] = {
+    "plans.open": open_plans,
+    "home.back": back_to_home,
+    "howitworks": show_how_it_works,
+    "unlock.access": unlock_access_prompt,
+    "myid.show": show_my_id,
+}
+
+
 # ======================
 # FastAPI Setup
 # ======================
@@ -528,84 +812,127 @@ async def lifespan(app: FastAPI):
     global application
     polling_task = None
 
-    # Startup
-    # Initialize database
-    if DATABASE_AVAILABLE:
-        try:
-            init_db()
-            with SessionLocal() as db:
-                logger.info("Database available (Postgres/SQL) - URL: %s", db_path_info(db))
-                # Lightweight SQLite migration: add missing columns if needed
-                try:
-                    _apply_sqlite_migrations(db)
-                except Exception as mig_err:
-                    logger.warning("DB migration step skipped/failed: %s", mig_err)
-        except Exception as e:
-            logger.exception("Failed to initialize database: %s", e)
-    else:
-        logger.warning("Database not available - running in limited mode")
-
-    # Configure bot
+    # Configure bot (checked before the log queue starts, so nothing needs undoing)
     if not TOKEN:
         raise RuntimeError("BOT_TOKEN not defined")
 
-    global application
-    application = ApplicationBuilder().token(TOKEN).build()
-
-    # Add handlers
-    setup_handlers(application)
-
     # Execution mode
     local_mode = os.getenv("LOCAL_POLLING", "0") == "1"
-    if local_mode:
-        # Local mode: initialize + start + start_polling (compatible with running event loop)
-        logger.info("Starting bot in LOCAL POLLING mode")
-        await application.initialize()
-        await application.start()
-        await application.updater.start_polling()
-    else:
-        # Production mode: webhook
-        if not PUBLIC_URL:
-            raise RuntimeError("PUBLIC_URL not defined for webhook")
-        await application.initialize()
-        await application.start()
-        webhook_url = f"{PUBLIC_URL}/telegram/{TOKEN}"
-        await application.bot.set_webhook(webhook_url)
-        logger.info(f"Bot webhook set to: {webhook_url}")
-
-    # Start auto-removal scheduler
-    logger.info(f"🔍 Scheduler initialization check:")
-    logger.info(f"   - DATABASE_AVAILABLE: {DATABASE_AVAILABLE}")
-    logger.info(f"   - ENABLE_AUTO_REMOVAL: {os.getenv('ENABLE_AUTO_REMOVAL', '1')}")
-    
-    if DATABASE_AVAILABLE and os.getenv("ENABLE_AUTO_REMOVAL", "1") == "1":
-        logger.info("🚀 Starting scheduler...")
-        try:
-            start_scheduler()
-            logger.info("✅ Scheduler initialization completed")
-        except Exception as e:
-            logger.error(f"❌ Failed to start scheduler in lifespan: {e}")
-    else:
-        logger.info("⏰ Auto-removal scheduler disabled")
+    if not local_mode and not PUBLIC_URL:
+        raise RuntimeError("PUBLIC_URL not defined for webhook")
+
+    # Startup
+    _start_log_queue()
+    # The listener thread is stopped (and queued records flushed) even if startup fails
+    try:
+        application = (
+            ApplicationBuilder()
+            .token(TOKEN)
+            .request(HTTPXRequest(
+                connection_pool_size=TELEGRAM_POOL_SIZE,
+                pool_timeout=TELEGRAM_POOL_TIMEOUT,
+                http_version=TELEGRAM_HTTP_VERSION,
+            ))
+            # getUpdates long-polls, so it gets its own small pool (only used with LOCAL_POLLING=1)
+            .get_updates_request(HTTPXRequest(connection_pool_size=1))
+            .concurrent_updates(BOT_CONCURRENT_UPDATES)
+            # Queues every Bot API call under Telegram's limits and retries on RetryAfter
+            .rate_limiter(AIORateLimiter(
+                overall_max_rate=30,
+                overall_time_period=1,
+                group_max_rate=20,
+                group_time_period=60,
+                max_retries=3,
+            ))
+            .build()
+        )
 
-    yield
+        # Add handlers
+        setup_handlers(application)
+
+        # Database setup (blocking I/O) runs in a worker thread while the bot
+        # initializes against the Telegram API
+        if DATABASE_AVAILABLE:
+            await asyncio.gather(asyncio.to_thread(_setup_database), application.initialize())
+        else:
+            logger.warning("Database not available - running in limited mode")
+            await application.initialize()
 
-    # Shutdown
-    if application:
         if local_mode:
+            # Local mode: initialize + start + start_polling (compatible with running event loop)
+            logger.info("Starting bot in LOCAL POLLING mode")
+            await application.start()
+            await application.updater.start_polling(allowed_updates=ALLOWED_UPDATES)
+        else:
+            # Production mode: webhook
+            await application.start()
+            webhook_url = f"{PUBLIC_URL}/telegram/{TOKEN}"
+            await application.bot.set_webhook(
+                webhook_url,
+                allowed_updates=ALLOWED_UPDATES,
+                secret_token=TG_WEBHOOK_SECRET,
+            )
+            logger.info("Bot webhook set to: %s", webhook_url)
+
+        # Start auto-removal scheduler
+        logger.info(f"🔍 Scheduler initialization check:")
+        logger.info(f"   - DATABASE_AVAILABLE: {DATABASE_AVAILABLE}")
+        logger.info(f"   - ENABLE_AUTO_REMOVAL: {os.getenv('ENABLE_AUTO_REMOVAL', '1')}")
+    
+        if DATABASE_AVAILABLE and os.getenv("ENABLE_AUTO_REMOVAL", "1") == "1":
+            logger.info("🚀 Starting scheduler...")
             try:
-                await application.updater.stop()
+                start_scheduler()
+                logger.info("✅ Scheduler initialization completed")
+            except Exception as e:
+                logger.error(f"❌ Failed to start scheduler in lifespan: {e}")
+        else:
+            logger.info("⏰ Auto-removal scheduler disabled")
+
+        yield
+
+        # Shutdown
+        if application:
+            if local_mode:
+                try:
+                    await application.updater.stop()
+                except Exception:
+                    pass
+            try:
+                await application.stop()
+                await application.shutdown()
             except Exception:
                 pass
-        try:
-            await application.stop()
-            await application.shutdown()
-        except Exception:
-            pass
-        logger.info("Bot application shut down")
+            logger.info("Bot application shut down")
     
-    # Stop scheduler
-    stop_scheduler()
+        # Stop scheduler
+        stop_scheduler()
+    finally:
+        _stop_log_queue()
+
+
+def _setup_database():
+    """Create tables/indexes, apply lightweight migrations and warm the pool (sync, runs off the event loop)"""
+    try:
+        init_db()
+        with SessionLocal() as db:
+            logger.info("Database available (Postgres/SQL) - URL: %s", db_path_info(db))
+            # Lightweight SQLite migration: add missing columns if needed
+            try:
+                _apply_sqlite_migrations(db)
+            except Exception as mig_err:
+                logger.warning("DB migration step skipped/failed: %s", mig_err)
+    except Exception as e:
+        logger.exception("Failed to initialize database: %s", e)
+    # On by default in production (webhook) mode, off for LOCAL_POLLING runs
+    default_warm = "0" if os.getenv("LOCAL_POLLING", "0") == "1" else "1"
+    if os.getenv("DB_POOL_WARM", default_warm) != "1":
+        return
+    try:
+        warmed = warm_connection_pool()
+        logger.info("DB pool warmed with %s connections", warmed)
+    except Exception as e:
+        logger.warning("DB pool warm-up failed: %s", e)
 
 
 def _apply_sqlite_migrations(session):
@@ -630,7 +957,8 @@ def _apply_sqlite_migrations(session):
 app = FastAPI(
     title="LukaMagicBOT",
     description="Telegram Bot + Stripe Webhook Integration",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # Sessions for admin area
@@ -723,15 +1051,35 @@ async def admin_logout(request: Request):
     return RedirectResponse(url="/admin/login", status_code=303)
 
 
+# Columns _subscription_row renders; the list view selects just these as plain Rows
+_SUBSCRIPTION_ROW_COLUMNS = (
+    models.Subscription.id,
+    models.Subscription.full_name,
+    models.Subscription.email,
+    models.Subscription.telegram_user_id,
+    models.Subscription.plan_type,
+    models.Subscription.status,
+    models.Subscription.created_at,
+    models.Subscription.expires_at,
+)
+
+
+def _h(x) -> str:
+    """HTML-escape a DB value for admin pages (None -> empty)"""
+    return "" if x is None else html.escape(str(x))
+
+
 def _subscription_row(s):
     # Determine if user should show "Expulsar" button
     show_expulsar = s.telegram_user_id and s.status in ["active", "expired", "cancelled", "canceled"]
     
     expulsar_button = ""
     if show_expulsar:
-        expulsar_button = f'<a class="button" href="/admin/subscriptions/{s.id}/expulsar" style="background: #dc2626; color: white; margin-left: 5px; padding: 6px 10px; font-size: 0.8em;" onclick="return confirm(\'Remove {s.email} from VIP groups?\');">🚫</a>'
+        # JSON string literal for the JS confirm(), then escaped for the attribute
+        confirm_msg = _h(orjson.dumps(f"Remove {s.email} from VIP groups?").decode())
+        expulsar_button = f'<a class="button" href="/admin/subscriptions/{s.id}/expulsar" style="background: #dc2626; color: white; margin-left: 5px; padding: 6px 10px; font-size: 0.8em;" onclick="return confirm({confirm_msg});">🚫</a>'
     
-    return f"<tr><td>{s.id}</td><td>{s.full_name or ''}</td><td>{s.email}</td><td>{s.telegram_user_id or ''}</td><td>{s.plan_type or ''}</td><td>{s.status or ''}</td><td>{(s.created_at or '')}</td><td>{(s.expires_at or '')}</td><td class=\"row\"><a class=\"button\" href=\"/admin/subscriptions/{s.id}/edit\">Edit</a><form method=\"post\" action=\"/admin/subscriptions/{s.id}/delete\" onsubmit=\"return confirm('Delete?');\"><input class=\"danger\" type=\"submit\" value=\"Delete\"/></form>{expulsar_button}</td></tr>"
+    return f"<tr><td>{s.id}</td><td>{_h(s.full_name)}</td><td>{_h(s.email)}</td><td>{_h(s.telegram_user_id)}</td><td>{_h(s.plan_type)}</td><td>{_h(s.status)}</td><td>{_h(s.created_at)}</td><td>{_h(s.expires_at)}</td><td class=\"row\"><a class=\"button\" href=\"/admin/subscriptions/{s.id}/edit\">Edit</a><form method=\"post\" action=\"/admin/subscriptions/{s.id}/delete\" onsubmit=\"return confirm('Delete?');\"><input class=\"danger\" type=\"submit\" value=\"Delete\"/></form>{expulsar_button}</td></tr>"
 
 
 @app.get("/admin/subscriptions", response_class=HTMLResponse)
@@ -745,7 +1093,7 @@ async def admin_list_subscriptions(
     search_status: str = ""
 ):
     _require_admin(request)
-    from sqlalchemy import desc
+    from sqlalchemy import desc, select, func
     
     try:
         # Simple audit log (without external module)
@@ -754,25 +1102,31 @@ async def admin_list_subscriptions(
         
         # Get subscriptions with search and pagination
         with SessionLocal() as db:
-            # Build query with search filters
-            query = db.query(models.Subscription)
-            
-            # Apply search filters
+            # Build search filters
+            filters = []
             if search_email:
-                query = query.filter(models.Subscription.email.ilike(f"%{search_email}%"))
+                filters.append(models.Subscription.email.ilike(f"%{search_email}%"))
             if search_name:
-                query = query.filter(models.Subscription.full_name.ilike(f"%{search_name}%"))
+                filters.append(models.Subscription.full_name.ilike(f"%{search_name}%"))
             if search_telegram:
-                query = query.filter(models.Subscription.telegram_user_id.ilike(f"%{search_telegram}%"))
+                filters.append(models.Subscription.telegram_user_id.ilike(f"%{search_telegram}%"))
             if search_status:
-                query = query.filter(models.Subscription.status.ilike(f"%{search_status}%"))
+                filters.append(models.Subscription.status.ilike(f"%{search_status}%"))
             
             # Get total count with filters
-            total_count = query.count()
+            total_count = db.execute(
+                select(func.count()).select_from(models.Subscription).where(*filters)
+            ).scalar_one()
             
-            # Get page data
+            # Get page data as plain Rows (read-only rendering, no ORM hydration)
             offset = (page - 1) * per_page
-            subs = query.order_by(desc(models.Subscription.id)).offset(offset).limit(per_page).all()
+            subs = db.execute(
+                select(*_SUBSCRIPTION_ROW_COLUMNS)
+                .where(*filters)
+                .order_by(desc(models.Subscription.id))
+                .offset(offset)
+                .limit(per_page)
+            ).all()
         
         total_pages = (total_count + per_page - 1) // per_page
         
@@ -937,12 +1291,10 @@ async def admin_edit_subscription_form(request: Request, sub_id: int):
         sub = db.query(models.Subscription).filter_by(id=sub_id).first()
         if not sub:
             raise HTTPException(status_code=404, detail="Not found")
-    def val(x):
-        return "" if x is None else str(x)
-    expires_val = val(sub.expires_at.date() if sub.expires_at else "")
+    expires_val = _h(sub.expires_at.date() if sub.expires_at else "")
     body = f"""
     <h1>Edit Subscription #{sub.id}</h1>
-    <form method=\"post\" action=\"/admin/subscriptions/{sub.id}\">\n<div class=\"row\">\n<label>Name <input name=\"full_name\" value=\"{val(sub.full_name)}\"/></label>\n<label>Email <input name=\"email\" value=\"{val(sub.email)}\" required/></label>\n<label>Telegram ID <input name=\"telegram_user_id\" value=\"{val(sub.telegram_user_id)}\"/></label>\n<label>Plan <select name=\"plan_type\"><option {'selected' if sub.plan_type=='monthly' else ''} value=\"monthly\">monthly</option><option {'selected' if sub.plan_type=='quarterly' else ''} value=\"quarterly\">quarterly</option><option {'selected' if sub.plan_type=='annual' else ''} value=\"annual\">annual</option></select></label>\n<label>Status <select name=\"status\"><option {'selected' if sub.status=='active' else ''} value=\"active\">active</option><option {'selected' if sub.status=='past_due' else ''} value=\"past_due\">past_due</option><option {'selected' if sub.status=='canceled' else ''} value=\"canceled\">canceled</option></select></label>\n<label>Expires at (YYYY-MM-DD) <input name=\"expires_at\" value=\"{expires_val}\"/></label>\n<input type=\"submit\" value=\"Save\"/>\n</div>\n</form>
+    <form method=\"post\" action=\"/admin/subscriptions/{sub.id}\">\n<div class=\"row\">\n<label>Name <input name=\"full_name\" value=\"{_h(sub.full_name)}\"/></label>\n<label>Email <input name=\"email\" value=\"{_h(sub.email)}\" required/></label>\n<label>Telegram ID <input name=\"telegram_user_id\" value=\"{_h(sub.telegram_user_id)}\"/></label>\n<label>Plan <select name=\"plan_type\"><option {'selected' if sub.plan_type=='monthly' else ''} value=\"monthly\">monthly</option><option {'selected' if sub.plan_type=='quarterly' else ''} value=\"quarterly\">quarterly</option><option {'selected' if sub.plan_type=='annual' else ''} value=\"annual\">annual</option></select></label>\n<label>Status <select name=\"status\"><option {'selected' if sub.status=='active' else ''} value=\"active\">active</option><option {'selected' if sub.status=='past_due' else ''} value=\"past_due\">past_due</option><option {'selected' if sub.status=='canceled' else ''} value=\"canceled\">canceled</option></select></label>\n<label>Expires at (YYYY-MM-DD) <input name=\"expires_at\" value=\"{expires_val}\"/></label>\n<input type=\"submit\" value=\"Save\"/>\n</div>\n</form>
     """
     return HTMLResponse(_html_page("Edit Subscription", body))
 
@@ -981,6 +1333,7 @@ async def admin_create_subscription(
         )
         db.add(sub)
         db.commit()
+    invalidate_subscription_cache(email)
     return RedirectResponse(url="/admin/subscriptions", status_code=303)
 
 
@@ -996,29 +1349,40 @@ async def admin_update_subscription(
     expires_at: str = Form(None),
 ):
     _require_admin(request)
+    from sqlalchemy import update
     with SessionLocal() as db:
-        sub = db.query(models.Subscription).filter_by(id=sub_id).first()
-        if not sub:
+        # Single UPDATE ... WHERE id = :id; rowcount tells whether the row existed
+        result = db.execute(
+            update(models.Subscription)
+            .where(models.Subscription.id == sub_id)
+            .values(
+                full_name=full_name,
+                email=email.lower().strip(),
+                telegram_user_id=telegram_user_id,
+                plan_type=plan_type,
+                status=status,
+                expires_at=_parse_date_or_none(expires_at),
+                updated_at=datetime.utcnow(),
+            )
+        )
+        if result.rowcount == 0:
             raise HTTPException(status_code=404, detail="Not found")
-        sub.full_name = full_name
-        sub.email = email.lower().strip()
-        sub.telegram_user_id = telegram_user_id
-        sub.plan_type = plan_type
-        sub.status = status
-        sub.expires_at = _parse_date_or_none(expires_at)
-        sub.updated_at = datetime.utcnow()
         db.commit()
+    # The email itself may have changed, so drop every cached lookup
+    invalidate_subscription_cache()
     return RedirectResponse(url="/admin/subscriptions", status_code=303)
 
 
 @app.post("/admin/subscriptions/{sub_id}/delete")
 async def admin_delete_subscription(request: Request, sub_id: int):
     _require_admin(request)
+    from sqlalchemy import delete
     with SessionLocal() as db:
-        sub = db.query(models.Subscription).filter_by(id=sub_id).first()
-        if sub:
-            db.delete(sub)
+        result = db.execute(delete(models.Subscription).where(models.Subscription.id == sub_id))
+        if result.rowcount:
             db.commit()
+            # The email is not loaded anymore, so drop every cached lookup
+            invalidate_subscription_cache()
     return RedirectResponse(url="/admin/subscriptions", status_code=303)
 
 
@@ -1109,6 +1473,7 @@ Hi! You have been manually removed from the VIP groups.
                 subscription.status = "manually_removed"
                 subscription.updated_at = datetime.utcnow()
                 db.commit()
+                invalidate_subscription_cache(email)
                 detail = "✅ Status updated to manually_removed"
                 logger.info(f"{email}: {detail}")
                 results['details'].append(detail)
@@ -1171,16 +1536,25 @@ async def telegram_webhook(token: str, request: Request):
     """
     Receive Telegram updates and process them via PTB.
 
-    Security: validate token in URL
+    Security: validate token in URL and, if configured, the secret token header
     """
     if token != TOKEN:
         logger.warning("Invalid token in webhook: %s", token)
         raise HTTPException(status_code=403, detail="Forbidden")
+    # Compare bytes: compare_digest raises TypeError on non-ASCII str input
+    if TG_WEBHOOK_SECRET and not secrets.compare_digest(
+        request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(),
+        TG_WEBHOOK_SECRET.encode(),
+    ):
+        logger.warning("Invalid secret token header in Telegram webhook")
+        raise HTTPException(status_code=403, detail="Forbidden")
 
     try:
-        update_data = await request.json()
+        update_data = orjson.loads(await request.body())
         update = Update.de_json(update_data, application.bot)
-        await application.process_update(update)
+        # Ack Telegram right away; the Application's update fetcher (started by
+        # application.start()) dispatches it under the concurrent_updates limit
+        await application.update_queue.put(update)
         return {"status": "ok"}
     except Exception as e:
         logger.critical(
@@ -1203,17 +1577,29 @@ async def stripe_webhook(request: Request):
         raise HTTPException(
             status_code=500, detail="Webhook secret not configured")
 
-    payload = await request.body()
+    try:
+        content_length = int(request.headers.get("content-length", "0"))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid Content-Length")
+    if content_length > STRIPE_WEBHOOK_MAX_BYTES:
+        raise HTTPException(status_code=413, detail="Payload too large")
+
     sig_header = request.headers.get('stripe-signature')
 
     if not sig_header:
         raise HTTPException(status_code=400, detail="Missing signature")
 
+    # Content-Length may be absent (chunked) or wrong: read into one growing
+    # buffer and stop as soon as the cap is crossed
+    payload = bytearray()
+    async for chunk in request.stream():
+        payload += chunk
+        if len(payload) > STRIPE_WEBHOOK_MAX_BYTES:
+            raise HTTPException(status_code=413, detail="Payload too large")
+
+    stripe = _get_stripe()
     try:
-        # Validate signature
-        event = stripe.Webhook.construct_event(
-            payload, sig_header, STRIPE_WEBHOOK_SECRET
-        )
+        event = await asyncio.to_thread(_construct_stripe_event, payload, sig_header)
     except ValueError as exc:
         logger.error("Invalid payload in stripe webhook: %s", exc)
         raise HTTPException(status_code=400, detail="Invalid payload") from exc
@@ -1222,24 +1608,39 @@ async def stripe_webhook(request: Request):
         raise HTTPException(
             status_code=400, detail="Invalid signature") from exc
 
-    # Processar evento
+    event_id = event['id']
+    if _processed_stripe_events.get(event_id):
+        logger.info("Stripe webhook duplicate skipped: %s", event_id)
+        return {"status": "received", "duplicate": True}
+
+    if STRIPE_WEBHOOK_ASYNC:
+        _fire_and_forget(_process_stripe_event(event))
+        return {"status": "received"}
+
+    if not await _process_stripe_event(event):
+        raise HTTPException(status_code=500, detail="Processing failed")
+    return {"status": "received"}
+
+
+async def _process_stripe_event(event) -> bool:
+    """Apply a verified Stripe event to the database"""
+    event_id = event['id']
     with SessionLocal() as db:
         logger.info("DB URL runtime: %s", db_path_info(db))
         try:
             success = await process_stripe_webhook_event(db, event)
-            if success:
-                logger.info(
-                    "Stripe webhook processed: %s (%s)", event['id'], event['type'])
-                return {"status": "received"}
-            else:
-                logger.error(
-                    "Failed to process stripe webhook: %s", event['id'])
-                raise HTTPException(
-                    status_code=500, detail="Processing failed")
         except Exception as e:
             logger.critical(
-                "Erro inesperado no handler do stripe webhook: %s", e, exc_info=True)
-            raise
+                "Erro inesperado no handler do stripe webhook: %s (event %s)", e, event_id, exc_info=True)
+            return False
+    if success:
+        # Only successful events are remembered so failed ones can be retried
+        _processed_stripe_events.set(event_id, True)
+        logger.info("Stripe webhook processed: %s (%s)", event_id, event['type'])
+    else:
+        # In async mode Stripe already got its 200: resend from the Dashboard
+        logger.error("Failed to process stripe webhook: %s (%s)", event_id, event['type'])
+    return success
 
 
 @app.post("/stripe/webhook-test")
@@ -1254,7 +1655,7 @@ async def stripe_webhook_test(request: Request):
         return {"status": "database_unavailable"}
 
     try:
-        event = await request.json()
+        event = orjson.loads(await request.body())
         logger.info(
             "Test webhook received: %s - %s",
             event.get('type', 'unknown'), event.get('id', 'no-id'))
@@ -1284,35 +1685,40 @@ async def stripe_webhook_test(request: Request):
 
 def setup_handlers(app: Application):
     """Configura todos os handlers do bot"""
+    # block=False: each handler runs as its own task, so a slow one (DB,
+    # invite creation) doesn't hold up the next update
     # Comandos
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("myid", cmd_myid))
-    app.add_handler(CommandHandler("groupid", groupid))
+    app.add_handler(CommandHandler("start", start, block=False))
+    app.add_handler(CommandHandler("myid", cmd_myid, block=False))
+    app.add_handler(CommandHandler("groupid", groupid, block=False))
     # Removed: testinvite command
 
     # ConversationHandler para Unlock Access
     conv = ConversationHandler(
         entry_points=[CallbackQueryHandler(
-            unlock_access_prompt, pattern=r"^unlock\.access$")],
+            unlock_access_prompt, pattern=UNLOCK_CB_RE, block=False)],
         states={
             ASK_EMAIL: [MessageHandler(
-                filters.TEXT & ~filters.COMMAND, unlock_access_check_email)]
+                filters.TEXT & ~filters.COMMAND, unlock_access_check_email, block=False)],
+            # unlock.access has no global route, so answer repeats here or the spinner hangs
+            ConversationHandler.WAITING: [CallbackQueryHandler(
+                _ack_only, pattern=UNLOCK_CB_RE, block=False)],
         },
         fallbacks=[
-            CommandHandler("cancel", unlock_cancel),
-            CallbackQueryHandler(back_to_home, pattern=r"^home\.back$")
+            CommandHandler("cancel", unlock_cancel, block=False),
+            CallbackQueryHandler(back_to_home, pattern=HOME_BACK_CB_RE, block=False)
         ],
         allow_reentry=True,
     )
     app.add_handler(conv)
 
-    # CallbackQueryHandler global para outros botões (exceto unlock.access e home.back no contexto da conversa)
-    app.add_handler(CallbackQueryHandler(
-        button_router, pattern=r"^(plans\.open|howitworks|myid\.show)$"))
-    
-    # Handler separado para home.back fora do contexto da conversa
-    app.add_handler(CallbackQueryHandler(
-        back_to_home, pattern=r"^home\.back$"))
+    # Um CallbackQueryHandler por botão (unlock.access pertence à conversa;
+    # home.back aqui cobre o uso fora da conversa)
+    for data, callback in CALLBACK_ROUTES.items():
+        if data == "unlock.access":
+            continue
+        pattern = HOME_BACK_CB_RE if data == "home.back" else re.compile(rf"^{re.escape(data)}$")
+        app.add_handler(CallbackQueryHandler(callback, pattern=pattern, block=False))
 # ======================
 # Main
 # ======================
@@ -1337,7 +1743,9 @@ def main():
         uvicorn.run(app, host="127.0.0.1", port=port, reload=False)
     else:
         logger.info("Starting in PRODUCTION mode: FastAPI + Bot Webhook")
-        uvicorn.run(app, host="0.0.0.0", port=port, reload=False)
+        # Same server setup as the Procfile: uvloop + httptools, no per-request access log
+        uvicorn.run(app, host="0.0.0.0", port=port, reload=False,
+                    loop="uvloop", http="httptools", access_log=False)
 
 
 # ======================
@@ -1346,8 +1754,6 @@ def main():
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
-import asyncio
-from typing import List, Dict, Any
 
 # Timezone e utilitários robustos
 TZ_NAME = os.getenv("TZ", "UTC")
@@ -1402,6 +1808,28 @@ async def safe_cleanup_expired_subscriptions():
                 logger.debug(f"heartbeat indisponível: {e}")
 
 
+# Retenção dos logs que o hot path consulta (mesmos padrões do /admin/cleanup/logs)
+INVITE_LOG_RETENTION_DAYS = int(os.getenv("INVITE_LOG_RETENTION_DAYS", "7"))
+STRIPE_EVENT_RETENTION_DAYS = int(os.getenv("STRIPE_EVENT_RETENTION_DAYS", "30"))
+
+
+def _cleanup_old_logs_sync() -> Dict[str, int]:
+    with SessionLocal() as db:
+        return {
+            "invite_logs": cleanup_old_invite_logs(db, INVITE_LOG_RETENTION_DAYS),
+            "stripe_events": cleanup_old_stripe_events(db, STRIPE_EVENT_RETENTION_DAYS),
+        }
+
+
+async def safe_cleanup_old_logs():
+    """Apaga invite_logs e stripe_events antigos para manter pequenas as tabelas do cooldown/idempotência"""
+    try:
+        results = await asyncio.to_thread(_cleanup_old_logs_sync)
+        logger.info("🧹 Log cleanup: %s", results)
+    except Exception as e:
+        logger.exception("❌ Log cleanup falhou: %s", e)
+
+
 async def _remove_user_from_vip_groups(bot, user_id: int, groups: List[int] = None) -> Dict[str, Any]:
     """
     Remove usuário dos grupos VIP
@@ -1455,7 +1883,7 @@ async def _send_renewal_dm(bot, user_id: int, email: str, plan_type: str = None)
         bool: True se enviou com sucesso
     """
     try:
-        plan_text = f" ({plan_type})" if plan_type else ""
+        plan_text = f" ({html.escape(plan_type)})" if plan_type else ""
         renewal_links = {
             'monthly': STRIPE_MONTHLY_URL,
             'quarterly': STRIPE_QUARTERLY_URL,
@@ -1466,19 +1894,19 @@ async def _send_renewal_dm(bot, user_id: int, email: str, plan_type: str = None)
         renewal_link = renewal_links.get(plan_type, STRIPE_MONTHLY_URL)
         
         message = f"""
-🚨 **VIP Access Expired**
+🚨 <b>VIP Access Expired</b>
 
 Hi! Your VIP subscription{plan_text} has expired and you've been removed from the VIP groups.
 
-📧 **Account**: {email}
-⏰ **Expired**: Just now
+📧 <b>Account</b>: {html.escape(email)}
+⏰ <b>Expired</b>: Just now
 
-🔄 **Renew Now**:
-• [Monthly Plan]({STRIPE_MONTHLY_URL})
-• [Quarterly Plan]({STRIPE_QUARTERLY_URL}) 
-• [Annual Plan]({STRIPE_ANNUAL_URL})
+🔄 <b>Renew Now</b>:
+• <a href="{STRIPE_MONTHLY_URL}">Monthly Plan</a>
+• <a href="{STRIPE_QUARTERLY_URL}">Quarterly Plan</a> 
+• <a href="{STRIPE_ANNUAL_URL}">Annual Plan</a>
 
-💬 **Need Help?** Contact support: @Sthefano_p
+💬 <b>Need Help?</b> Contact support: @Sthefano_p
 
 Thank you for being a VIP member! 🌟
         """.strip()
@@ -1486,7 +1914,7 @@ Thank you for being a VIP member! 🌟
         await bot.send_message(
             chat_id=user_id,
             text=message,
-            parse_mode="Markdown",
+            parse_mode=ParseMode.HTML,
             disable_web_page_preview=True
         )
         
@@ -1903,6 +2331,16 @@ def start_scheduler():
             )
             logger.info(f"✅ Notification job added - will run daily at {notification_time}:00 {TZ_NAME}")
 
+        # JOB HORÁRIO: LIMPEZA DE LOGS (invite_logs / stripe_events)
+        if os.getenv("ENABLE_LOG_CLEANUP", "1") == "1":
+            scheduler.add_job(
+                safe_cleanup_old_logs, "interval",
+                hours=1, id="cleanup_old_logs",
+                name="Cleanup Old Logs",
+                replace_existing=True
+            )
+            logger.info("✅ Log cleanup job added - will run every hour")
+
         # HEARTBEAT a cada 1 min (se existir a função)
         try:
             scheduler.add_job(
@@ -3410,6 +3848,7 @@ Thank you for being a VIP member! 🌟"""
                         sub.status = "auto_removed"
                         sub.updated_at = datetime.utcnow()
                         db.commit()
+                        invalidate_subscription_cache(email)
                         
                         detail = f"✅ {email}: Status updated to auto_removed"
                         logger.info(detail)
@@ -4208,9 +4647,6 @@ async def admin_debug_specific_users(request: Request):
         ))
 
 
-if __name__ == "__main__":
-    main()
-
 # ======================
 # 🗑️ Cleanup Routes
 # ======================
@@ -4276,3 +4712,6 @@ async def admin_clear_removal_logs(request: Request):
         
         return HTMLResponse(_html_page("Erro na Limpeza", body))
 
+
+if __name__ == "__main__":
+    main()
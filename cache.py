@@ -0,0 +1,51 @@
+"""
+Small in-process TTL cache for LukaMagicBOT
+Used to collapse repeated lookups within a short time window
+"""
+import time
+from typing import Any, Hashable
+
+
+class TTLCache:
+    """
+    Dict-backed cache whose entries expire `ttl` seconds after being set.
+    When full, expired entries are dropped first, then the oldest ones.
+    """
+    __slots__ = ("maxsize", "ttl", "_data")
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = {}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            self._data.pop(key, None)
+            return default
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        if key not in self._data and len(self._data) >= self.maxsize:
+            self._evict()
+        self._data[key] = (time.monotonic() + self.ttl, value)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _evict(self) -> None:
+        now = time.monotonic()
+        for key in [k for k, (exp, _) in self._data.items() if exp < now]:
+            del self._data[key]
+        while len(self._data) >= self.maxsize:
+            del self._data[next(iter(self._data))]
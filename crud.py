@@ -1,13 +1,89 @@
 import os
 from datetime import datetime, timedelta
 import logging
+from dataclasses import dataclass
 from typing import Optional
+from sqlalchemy import select, bindparam, or_, func
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import Session
 from models import InviteLog
+from cache import TTLCache
 
 import models
 logger = logging.getLogger(__name__)
 
+# Short-lived cache for unlock lookups, keyed by normalized email.
+# Every writer below that touches a subscription invalidates its entry.
+# SUBSCRIPTION_CACHE_TTL=0 disables it (e.g. several app instances sharing one DB).
+SUBSCRIPTION_CACHE_TTL = float(os.getenv("SUBSCRIPTION_CACHE_TTL", "30"))
+_subscription_cache = TTLCache(maxsize=5000, ttl=SUBSCRIPTION_CACHE_TTL)
+_CACHE_MISS = object()
+
+
+@dataclass(frozen=True)
+class SubscriptionSnapshot:
+    """Read-only copy of the Subscription fields the unlock flow reads.
+    Cached instead of the ORM instance, which is tied to the session that loaded it."""
+    id: int
+    email: str
+    plan_type: Optional[str]
+    status: Optional[str]
+    expires_at: Optional[datetime]
+
+    @classmethod
+    def from_model(cls, sub: "models.Subscription") -> "SubscriptionSnapshot":
+        return cls(id=sub.id, email=sub.email, plan_type=sub.plan_type,
+                   status=sub.status, expires_at=sub.expires_at)
+
+# Statements used on the unlock/webhook hot paths, built once at import so
+# each call only binds parameters instead of rebuilding the query.
+_STMT_EVENT_PROCESSED = (
+    select(models.StripeEvent.event_id)
+    .where(models.StripeEvent.event_id == bindparam("event_id"))
+    .limit(1)
+)
+_STMT_ACTIVE_BY_EMAIL = (
+    select(models.Subscription)
+    .where(
+        func.lower(models.Subscription.email) == bindparam("email"),
+        models.Subscription.status == "active",
+    )
+    .limit(1)
+)
+_STMT_ACTIVE_NOT_EXPIRED_BY_EMAIL = (
+    select(models.Subscription)
+    .where(
+        func.lower(models.Subscription.email) == bindparam("email"),
+        models.Subscription.status == "active",
+        or_(models.Subscription.expires_at.is_(None), models.Subscription.expires_at >= bindparam("now")),
+    )
+    .limit(1)
+)
+_STMT_RECENT_INVITE_FOR_EMAIL = (
+    select(models.InviteLog)
+    .where(models.InviteLog.email == bindparam("email"), models.InviteLog.created_at >= bindparam("threshold"))
+    .order_by(models.InviteLog.created_at.desc())
+    .limit(1)
+)
+_STMT_RECENT_INVITE_FOR_USER = (
+    select(models.InviteLog)
+    .where(models.InviteLog.telegram_user_id == bindparam("telegram_user_id"), models.InviteLog.created_at >= bindparam("threshold"))
+    .order_by(models.InviteLog.created_at.desc())
+    .limit(1)
+)
+_STMT_RECENT_INVITE_FOR_EMAIL_OR_USER = (
+    select(models.InviteLog)
+    .where(
+        or_(
+            models.InviteLog.email == bindparam("email"),
+            models.InviteLog.telegram_user_id == bindparam("telegram_user_id"),
+        ),
+        models.InviteLog.created_at >= bindparam("threshold"),
+    )
+    .order_by(models.InviteLog.created_at.desc())
+    .limit(1)
+)
+
 PRICE_PLAN_MAP = {
     (os.getenv("PRICE_MONTHLY_ID") or "").strip(): "monthly",
     (os.getenv("PRICE_QUARTERLY_ID") or "").strip(): "quarterly",
@@ -25,38 +101,57 @@ def _digits_only(s: str) -> str:
 
 def event_already_processed(db, event_id: str) -> bool:
     """Verifica se evento Stripe já foi processado (idempotência)."""
-    return db.query(models.StripeEvent).filter_by(event_id=event_id).first() is not None
+    return db.execute(_STMT_EVENT_PROCESSED, {"event_id": event_id}).first() is not None
 
-def log_event(db, event_id: str) -> None:
-    """Registra evento Stripe como processado."""
+def log_event(db, event_id: str) -> bool:
+    """Registra evento Stripe como processado. False se outra entrega já o registrou."""
     db.add(models.StripeEvent(event_id=event_id))
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # Entrega concorrente do mesmo evento: a PK de event_id já existe
+        db.rollback()
+        return False
+    return True
 
 def get_active_by_email(db, email: str):
     """Busca assinatura ativa por email."""
-    return db.query(models.Subscription).filter_by(email=email.lower().strip(), status="active").first()
+    return db.execute(_STMT_ACTIVE_BY_EMAIL, {"email": email.lower().strip()}).scalars().first()
 
 def get_active_and_not_expired_by_email(db, email: str):
     """Active AND not expired (expires_at is null OR expires_at >= now)."""
-    now = datetime.utcnow()
-    return (
-        db.query(models.Subscription)
-        .filter(
-            models.Subscription.email == email.lower().strip(),
-            models.Subscription.status == "active",
-            ((models.Subscription.expires_at == None) | (models.Subscription.expires_at >= now)),
-        )
-        .first()
-    )
+    params = {"email": email.lower().strip(), "now": datetime.utcnow()}
+    return db.execute(_STMT_ACTIVE_NOT_EXPIRED_BY_EMAIL, params).scalars().first()
+
+def get_active_and_not_expired_by_email_cached(db, email: str) -> Optional[SubscriptionSnapshot]:
+    """Cached variant of get_active_and_not_expired_by_email (negative results are cached too).
+    Returns a SubscriptionSnapshot, never a session-bound ORM instance."""
+    key = email.lower().strip()
+    if SUBSCRIPTION_CACHE_TTL <= 0:
+        sub = get_active_and_not_expired_by_email(db, key)
+        return SubscriptionSnapshot.from_model(sub) if sub else None
+    snapshot = _subscription_cache.get(key, _CACHE_MISS)
+    if snapshot is _CACHE_MISS:
+        sub = get_active_and_not_expired_by_email(db, key)
+        snapshot = SubscriptionSnapshot.from_model(sub) if sub else None
+        _subscription_cache.set(key, snapshot)
+    return snapshot
+
+def invalidate_subscription_cache(email: Optional[str] = None) -> None:
+    """Drop the cached lookup for one email, or the whole cache when email is None."""
+    if email is None:
+        _subscription_cache.clear()
+    else:
+        _subscription_cache.pop(email.lower().strip(), None)
 
 def get_subscription_by_email(db, email: str):
     """Return any subscription record by email regardless of status."""
-    return db.query(models.Subscription).filter(models.Subscription.email == email.lower().strip()).first()
+    return db.query(models.Subscription).filter(func.lower(models.Subscription.email) == email.lower().strip()).first()
 
 def update_full_name_if_empty(db, email: str, full_name: str) -> bool:
     if not email or not full_name:
         return False
-    sub = db.query(models.Subscription).filter(models.Subscription.email == email.lower().strip()).first()
+    sub = db.query(models.Subscription).filter(func.lower(models.Subscription.email) == email.lower().strip()).first()
     if not sub:
         return False
     if getattr(sub, "full_name", None):
@@ -67,21 +162,26 @@ def update_full_name_if_empty(db, email: str, full_name: str) -> bool:
     except Exception:
         pass
     db.commit()
+    invalidate_subscription_cache(email)
     logger.info("Full name set for email=%s", email)
     return True
 
 def mark_telegram_id(db, email: str, telegram_user_id: str) -> bool:
     if not email or not telegram_user_id:
         return False
-    sub = db.query(models.Subscription).filter(models.Subscription.email == email.lower().strip()).first()
+    sub = db.query(models.Subscription).filter(func.lower(models.Subscription.email) == email.lower().strip()).first()
     if not sub:
         return False
+    if sub.telegram_user_id == telegram_user_id:
+        # Nothing written; cached SubscriptionSnapshots don't carry telegram_user_id, so no invalidation
+        return True
     sub.telegram_user_id = telegram_user_id
     try:
         sub.updated_at = datetime.utcnow()
     except Exception:
         pass
     db.commit()
+    invalidate_subscription_cache(email)
     logger.info("Telegram ID set for email=%s", email)
     return True
 
@@ -127,7 +227,7 @@ def upsert_subscription_from_checkout_session(db, session: dict) -> bool:
         sub_id = session.get("subscription")
 
         Subscription = models.Subscription
-        sub = db.query(Subscription).filter(Subscription.email == email).first()
+        sub = db.query(Subscription).filter(func.lower(Subscription.email) == email).first()
 
         if not sub:
             sub = Subscription(
@@ -142,6 +242,7 @@ def upsert_subscription_from_checkout_session(db, session: dict) -> bool:
             )
             db.add(sub)
             db.commit()
+            invalidate_subscription_cache(email)
             logger.info("Created subscription (checkout.completed): email=%s status=%s tg=%s sub=%s",
                         email, sub.status, telegram_id, sub_id)
         else:
@@ -157,11 +258,13 @@ def upsert_subscription_from_checkout_session(db, session: dict) -> bool:
             if changed:
                 sub.updated_at = datetime.utcnow()
                 db.commit()
+                invalidate_subscription_cache(email)
                 logger.info("Updated subscription (checkout.completed): email=%s status=%s tg=%s sub=%s",
                             email, sub.status, telegram_id, sub_id)
         return True
     except Exception as e:
         logger.warning("upsert_subscription_from_checkout_session failed: %s", e, exc_info=True)
+        db.rollback()
         return False
 
 def upsert_subscription_from_invoice(db, invoice: dict) -> bool:
@@ -190,16 +293,22 @@ def upsert_subscription_from_invoice(db, invoice: dict) -> bool:
 
         Subscription = models.Subscription
         sub = None
-        if email:
-            sub = db.query(Subscription).filter(Subscription.email == email).first()
-        # fallback by stripe_subscription_id if email missing
-        if not sub and sub_id:
+        # stripe_subscription_id is the stable key for renewals; email is the fallback
+        if sub_id:
             sub = db.query(Subscription).filter(Subscription.stripe_subscription_id == sub_id).first()
+        if not sub and email:
+            sub = db.query(Subscription).filter(func.lower(Subscription.email) == email).first()
+
+        if not sub and not email:
+            # An email-less row would collide on the unique email column;
+            # checkout.session.completed creates the row instead.
+            logger.warning("invoice without email for unknown subscription %s; skipping create", sub_id)
+            return False
 
         if not sub:
             # create minimal if nothing exists
             sub = Subscription(
-                email=email or "",
+                email=email,
                 stripe_subscription_id=sub_id or None,
                 plan_type=plan_type,
                 status="active",
@@ -215,6 +324,7 @@ def upsert_subscription_from_invoice(db, invoice: dict) -> bool:
                 sub.expires_at = datetime.utcnow() + timedelta(days=365)
             db.add(sub)
             db.commit()
+            invalidate_subscription_cache(sub.email)
             logger.info("Created subscription (invoice.paid): email=%s plan=%s sub=%s", email, plan_type, sub_id)
         else:
             changed = False
@@ -241,11 +351,13 @@ def upsert_subscription_from_invoice(db, invoice: dict) -> bool:
             if changed:
                 sub.updated_at = datetime.utcnow()
                 db.commit()
+                invalidate_subscription_cache(sub.email)
                 logger.info("Updated subscription (invoice.paid): email=%s plan=%s sub=%s exp=%s",
                             email, plan_type, sub_id, sub.expires_at)
         return True
     except Exception as e:
         logger.warning("upsert_subscription_from_invoice failed: %s", e, exc_info=True)
+        db.rollback()
         return False
 
 # ======================
@@ -255,23 +367,28 @@ def upsert_subscription_from_invoice(db, invoice: dict) -> bool:
 def get_recent_invite_for_email(db, email: str, cooldown_seconds: int) -> Optional[models.InviteLog]:
     """Return the most recent invite for this email within the cooldown window, if any."""
     threshold = datetime.utcnow() - timedelta(seconds=cooldown_seconds)
-    return (
-        db.query(models.InviteLog)
-        .filter(models.InviteLog.email == email.lower().strip(), models.InviteLog.created_at >= threshold)
-        .order_by(models.InviteLog.created_at.desc())
-        .first()
-    )
+    params = {"email": email.lower().strip(), "threshold": threshold}
+    return db.execute(_STMT_RECENT_INVITE_FOR_EMAIL, params).scalars().first()
 
 
 def get_recent_invite_for_user(db, telegram_user_id: str, cooldown_seconds: int) -> Optional[models.InviteLog]:
     """Return the most recent invite for this telegram_user_id within the cooldown window, if any."""
     threshold = datetime.utcnow() - timedelta(seconds=cooldown_seconds)
-    return (
-        db.query(models.InviteLog)
-        .filter(models.InviteLog.telegram_user_id == str(telegram_user_id), models.InviteLog.created_at >= threshold)
-        .order_by(models.InviteLog.created_at.desc())
-        .first()
-    )
+    params = {"telegram_user_id": str(telegram_user_id), "threshold": threshold}
+    return db.execute(_STMT_RECENT_INVITE_FOR_USER, params).scalars().first()
+
+
+def get_recent_invite_for_email_or_user(
+    db, email: str, telegram_user_id: str, cooldown_seconds: int
+) -> Optional[models.InviteLog]:
+    """Most recent invite for this email OR telegram_user_id within the cooldown window (one query)."""
+    threshold = datetime.utcnow() - timedelta(seconds=cooldown_seconds)
+    params = {
+        "email": email.lower().strip(),
+        "telegram_user_id": str(telegram_user_id),
+        "threshold": threshold,
+    }
+    return db.execute(_STMT_RECENT_INVITE_FOR_EMAIL_OR_USER, params).scalars().first()
 
 
 def log_invite(
@@ -316,14 +433,15 @@ def update_subscription_status(db: Session, stripe_subscription_id: str, status:
             subscription.status = status
             subscription.updated_at = datetime.utcnow()
             db.commit()
-            logger.info(f"Updated subscription {stripe_subscription_id} status to {status}")
+            invalidate_subscription_cache(subscription.email)
+            logger.info("Updated subscription %s status to %s", stripe_subscription_id, status)
             return True
         else:
-            logger.warning(f"Subscription not found for stripe_subscription_id: {stripe_subscription_id}")
+            logger.warning("Subscription not found for stripe_subscription_id: %s", stripe_subscription_id)
             return False
             
     except Exception as e:
-        logger.error(f"Error updating subscription status: {e}")
+        logger.error("Error updating subscription status: %s", e)
         db.rollback()
         return False
 
@@ -334,7 +452,6 @@ def update_subscription_status(db: Session, stripe_subscription_id: str, status:
 
 def get_expired_subscriptions(db: Session):
     """Buscar assinaturas expiradas que ainda estão ativas"""
-    from datetime import datetime
     now = datetime.utcnow()
     return (
         db.query(models.Subscription)
@@ -506,6 +623,7 @@ def mark_subscription_processed(db: Session, subscription_id: int, new_status: s
             subscription.status = new_status
             subscription.updated_at = datetime.utcnow()
             db.commit()
+            invalidate_subscription_cache(subscription.email)
             return True
         return False
     except Exception as e:
@@ -520,8 +638,6 @@ def mark_subscription_processed(db: Session, subscription_id: int, new_status: s
 
 def get_subscriptions_expiring_in_days(db: Session, days: int):
     """Buscar assinaturas que expiram em X dias"""
-    from datetime import datetime, timedelta
-    
     # Calculate target date range
     now = datetime.utcnow()
     target_date_start = now + timedelta(days=days)
@@ -541,8 +657,6 @@ def get_subscriptions_expiring_in_days(db: Session, days: int):
 
 def get_subscriptions_in_grace_period(db: Session, grace_period_days: int = 3):
     """Buscar assinaturas expiradas mas ainda no grace period"""
-    from datetime import datetime, timedelta
-    
     now = datetime.utcnow()
     grace_cutoff = now - timedelta(days=grace_period_days)
     
@@ -560,8 +674,6 @@ def get_subscriptions_in_grace_period(db: Session, grace_period_days: int = 3):
 
 def get_subscriptions_past_grace_period(db: Session, grace_period_days: int = 3):
     """Buscar assinaturas que passaram do grace period (devem ser removidas)"""
-    from datetime import datetime, timedelta
-    
     now = datetime.utcnow()
     grace_cutoff = now - timedelta(days=grace_period_days)
     
@@ -646,21 +758,16 @@ def get_recent_notifications(db: Session, limit: int = 100):
 
 def cleanup_old_stripe_events(db: Session, days_old: int = 30) -> int:
     """Limpar eventos Stripe antigos"""
-    from datetime import datetime, timedelta
-    
     try:
         cutoff_date = datetime.utcnow() - timedelta(days=days_old)
         
-        old_events = (
+        # Single DELETE ... WHERE instead of loading and deleting row by row
+        count = (
             db.query(models.StripeEvent)
             .filter(models.StripeEvent.received_at < cutoff_date)
-            .all()
+            .delete(synchronize_session=False)
         )
-        
-        count = len(old_events)
         if count > 0:
-            for event in old_events:
-                db.delete(event)
             db.commit()
             logger.info(f"🧹 Cleaned {count} old Stripe events (older than {days_old} days)")
         
@@ -674,21 +781,15 @@ def cleanup_old_stripe_events(db: Session, days_old: int = 30) -> int:
 
 def cleanup_old_invite_logs(db: Session, days_old: int = 7) -> int:
     """Limpar logs de convites antigos"""
-    from datetime import datetime, timedelta
-    
     try:
         cutoff_date = datetime.utcnow() - timedelta(days=days_old)
         
-        old_invites = (
+        count = (
             db.query(models.InviteLog)
             .filter(models.InviteLog.created_at < cutoff_date)
-            .all()
+            .delete(synchronize_session=False)
         )
-        
-        count = len(old_invites)
         if count > 0:
-            for invite in old_invites:
-                db.delete(invite)
             db.commit()
             logger.info(f"🧹 Cleaned {count} old invite logs (older than {days_old} days)")
         
@@ -702,21 +803,15 @@ def cleanup_old_invite_logs(db: Session, days_old: int = 7) -> int:
 
 def cleanup_old_removal_logs(db: Session, days_old: int = 30) -> int:
     """Limpar logs de remoção antigos"""
-    from datetime import datetime, timedelta
-    
     try:
         cutoff_date = datetime.utcnow() - timedelta(days=days_old)
         
-        old_removals = (
+        count = (
             db.query(models.RemovalLog)
             .filter(models.RemovalLog.created_at < cutoff_date)
-            .all()
+            .delete(synchronize_session=False)
         )
-        
-        count = len(old_removals)
         if count > 0:
-            for removal in old_removals:
-                db.delete(removal)
             db.commit()
             logger.info(f"🧹 Cleaned {count} old removal logs (older than {days_old} days)")
         
@@ -730,21 +825,15 @@ def cleanup_old_removal_logs(db: Session, days_old: int = 30) -> int:
 
 def cleanup_old_notification_logs(db: Session, days_old: int = 30) -> int:
     """Limpar logs de notificação antigos"""
-    from datetime import datetime, timedelta
-    
     try:
         cutoff_date = datetime.utcnow() - timedelta(days=days_old)
         
-        old_notifications = (
+        count = (
             db.query(models.NotificationLog)
             .filter(models.NotificationLog.sent_at < cutoff_date)
-            .all()
+            .delete(synchronize_session=False)
         )
-        
-        count = len(old_notifications)
         if count > 0:
-            for notification in old_notifications:
-                db.delete(notification)
             db.commit()
             logger.info(f"🧹 Cleaned {count} old notification logs (older than {days_old} days)")
         
@@ -1,6 +1,8 @@
 import os
+import logging
 import pathlib
-from sqlalchemy import create_engine
+from typing import Optional
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker, declarative_base
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./lukabot.db")
@@ -11,9 +13,23 @@ if DATABASE_URL.startswith("sqlite:///"):
     DATABASE_URL = f"sqlite:///{abs_path}"
     connect_args = {"check_same_thread": False}
 
-engine = create_engine(DATABASE_URL, future=True, pool_pre_ping=True, connect_args=connect_args)
+if not DATABASE_URL.startswith("sqlite"):
+    # Pool sizing tunable per deploy; pre_ping stays off by default because it
+    # leaves idle-in-transaction backends behind PgBouncer (transaction mode).
+    engine_kwargs = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "5")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "60")),
+        "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", "30")),
+        "pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "0") == "1",
+    }
+else:
+    engine_kwargs = {"pool_pre_ping": True}
+
+engine = create_engine(DATABASE_URL, future=True, connect_args=connect_args, **engine_kwargs)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, expire_on_commit=False, future=True)
 Base = declarative_base()
+logger = logging.getLogger(__name__)
 
 def db_url_info() -> str:
     return engine.url.render_as_string(hide_password=True)
@@ -36,3 +52,61 @@ def init_db() -> None:
     # Import models to register metadata
     import models  # noqa: F401
     Base.metadata.create_all(bind=engine)
+    ensure_indexes()
+
+
+def _existing_index_names() -> Optional[set]:
+    """
+    Index names already in the database, read from the catalog by name.
+    Reflection (checkfirst=True) cannot see expression indexes such as
+    ux_subscriptions_email_lower on SQLite. None for other dialects.
+    """
+    dialect = engine.dialect.name
+    if dialect == "sqlite":
+        sql = "SELECT name FROM sqlite_master WHERE type = 'index'"
+    elif dialect == "postgresql":
+        sql = "SELECT indexname FROM pg_indexes WHERE schemaname = current_schema()"
+    else:
+        return None
+    with engine.connect() as conn:
+        return {row[0] for row in conn.execute(text(sql))}
+
+
+def ensure_indexes() -> None:
+    """
+    Create model indexes that are missing on already existing tables.
+    create_all() only emits CREATE INDEX together with CREATE TABLE.
+    """
+    existing = _existing_index_names()
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if existing is not None and index.name in existing:
+                continue
+            try:
+                index.create(bind=engine, checkfirst=existing is None)
+            except Exception as e:
+                logger.warning("Could not create index %s: %s", index.name, e)
+
+
+def warm_connection_pool(size: Optional[int] = None) -> int:
+    """
+    Open `size` pooled connections (default: the pool size) and return them to the pool,
+    so the first requests after a deploy skip the connect/auth handshake.
+    Returns how many connections were opened.
+    """
+    if size is None:
+        try:
+            size = engine.pool.size()
+        except Exception:
+            size = 1
+    conns = []
+    try:
+        # Hold every connection until all are open, otherwise the pool hands back the same one
+        for _ in range(size):
+            conn = engine.connect()
+            conns.append(conn)
+            conn.execute(text("SELECT 1"))
+    finally:
+        for conn in conns:
+            conn.close()
+    return len(conns)
@@ -18,6 +18,16 @@ class Subscription(Base):
     updated_at: Mapped[DateTime] = mapped_column(DateTime, server_default=func.now(), onupdate=func.now(), nullable=False)
 
 Index("ix_subscriptions_email_status", Subscription.email, Subscription.status)
+# Case-insensitive uniqueness; lookups compare lower(email) so they use this index
+Index("ux_subscriptions_email_lower", func.lower(Subscription.email), unique=True)
+# One row per Stripe subscription; rows without one (manual/admin) are not constrained
+Index(
+    "ux_subscriptions_stripe_subscription_id",
+    Subscription.stripe_subscription_id,
+    unique=True,
+    postgresql_where=Subscription.stripe_subscription_id.isnot(None),
+    sqlite_where=Subscription.stripe_subscription_id.isnot(None),
+)
 
 class StripeEvent(Base):
     __tablename__ = "stripe_events"
@@ -37,6 +47,7 @@ class InviteLog(Base):
     expires_at: Mapped[DateTime | None] = mapped_column(DateTime)
 
 Index("ix_invite_logs_email_created", InviteLog.email, InviteLog.created_at)
+Index("ix_invite_logs_user_created", InviteLog.telegram_user_id, InviteLog.created_at)
 
 
 class RemovalLog(Base):
@@ -0,0 +1,32 @@
+"""
+Client-side rate limiting for LukaMagicBOT
+Keeps outgoing Bot API calls under Telegram's flood limits instead of hitting 429s
+"""
+import asyncio
+import time
+
+
+class AsyncTokenBucket:
+    """
+    Token bucket refilled at `rate` tokens/second up to `capacity`.
+    acquire() waits until a token is available; waiters are served in order.
+    """
+    __slots__ = ("rate", "capacity", "_tokens", "_updated", "_lock")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
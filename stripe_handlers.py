@@ -1,9 +1,6 @@
+import asyncio
 import logging
 from typing import Dict, Any, Optional, Tuple
-try:
-    import stripe
-except ImportError:
-    stripe = None
 from sqlalchemy.orm import Session
 from crud import (
     event_already_processed,
@@ -11,18 +8,19 @@ from crud import (
     upsert_subscription_from_checkout_session,
     upsert_subscription_from_invoice,
     update_subscription_status,
+    update_full_name_if_empty,
     mark_telegram_id
 )
 
 logger = logging.getLogger("stripe_handlers")
 
 def _extract_email_and_name(session: dict) -> Tuple[Optional[str], Optional[str]]:
-    cd = (session or {}).get("customer_details") or {}
-    email = (cd.get("email") or (session or {}).get("customer_email") or None)
-    name = cd.get("name") if isinstance(cd, dict) else None
-    if isinstance(email, str): email = email.strip().lower()
-    if isinstance(name, str): name = name.strip()
-    return email, name
+    session = session or {}
+    cd = session.get("customer_details") or {}
+    email = cd.get("email") or session.get("customer_email")
+    name = cd.get("name")
+    return (email.strip().lower() if isinstance(email, str) else None,
+            name.strip() if isinstance(name, str) else None)
 
 def _extract_telegram_id_from_session(session: dict) -> Optional[str]:
     # TEXT first
@@ -70,10 +68,28 @@ def _map_stripe_status(stripe_status: str) -> str:
 
 async def process_stripe_webhook_event(db: Session, event: dict) -> bool:
     event_id = event.get("id")
-    event_type = event.get("type")
-    if event_already_processed(db, event_id):
-        logger.info(f"Event {event_id} already processed, skipping")
+    if await asyncio.to_thread(event_already_processed, db, event_id):
+        logger.info("Event %s already processed, skipping", event_id)
         return True
+    ok, applied = await _dispatch_stripe_event(db, event)
+    if applied and event_id:
+        # Só eventos efetivamente aplicados (ou no-op intencional) entram em stripe_events;
+        # falhas continuam reprocessáveis por um resend
+        try:
+            if not await asyncio.to_thread(log_event, db, event_id):
+                logger.info("Event %s recorded by a concurrent delivery", event_id)
+        except Exception as e:
+            logger.warning("Could not record event %s as processed: %s", event_id, e)
+    return ok
+
+async def _dispatch_stripe_event(db: Session, event: dict) -> Tuple[bool, bool]:
+    """
+    Apply one event. Returns (ok, applied): `ok` decides the HTTP answer to Stripe
+    (handled types are always acked); `applied` is True only when the change reached
+    the database or the event is an intentional no-op, so it can be marked processed.
+    """
+    event_id = event.get("id")
+    event_type = event.get("type")
     try:
         if event_type == "checkout.session.completed":
             session = event["data"]["object"]
@@ -85,52 +101,51 @@ async def process_stripe_webhook_event(db: Session, event: dict) -> bool:
                 tg = _extract_telegram_id_from_session(session)
                 if email:
                     try:
-                        from crud import update_full_name_if_empty, mark_telegram_id
                         if full_name:
-                            update_full_name_if_empty(db, email, full_name)
+                            await asyncio.to_thread(update_full_name_if_empty, db, email, full_name)
                         if tg:
-                            mark_telegram_id(db, email, tg)
+                            await asyncio.to_thread(mark_telegram_id, db, email, tg)
                     except Exception as e:
                         logger.warning("Non-subscription enrich failed: %s", e)
-                return True
+                return True, True
+            applied = False
             try:
-                from crud import upsert_subscription_from_checkout_session
-                ok = upsert_subscription_from_checkout_session(db, session)
-                if not ok:
+                applied = await asyncio.to_thread(upsert_subscription_from_checkout_session, db, session)
+                if not applied:
                     logger.warning("Checkout upsert returned False; invoice.paid will finalize.")
             except Exception as e:
                 logger.warning("Checkout upsert raised; continuing 200 to Stripe: %s", e, exc_info=True)
-            return True
+            return True, applied
         elif event_type in ("invoice.paid", "invoice.payment_succeeded"):
             invoice = event["data"]["object"]
+            applied = False
             try:
-                from crud import upsert_subscription_from_invoice
-                ok = upsert_subscription_from_invoice(db, invoice)
-                if not ok:
+                applied = await asyncio.to_thread(upsert_subscription_from_invoice, db, invoice)
+                if not applied:
                     logger.warning("Invoice upsert returned False")
             except Exception as e:
                 logger.warning("Invoice upsert raised; continuing 200 to Stripe: %s", e, exc_info=True)
-            return True
+            return True, applied
         elif event_type == "customer.subscription.updated":
             subscription_obj = event["data"]["object"]
             stripe_sub_id = subscription_obj.get("id")
             status = subscription_obj.get("status")
             our_status = _map_stripe_status(status)
-            logger.info(f"Updating subscription {stripe_sub_id}: status={our_status}")
-            success = update_subscription_status(db, stripe_sub_id, our_status)
+            logger.info("Updating subscription %s: status=%s", stripe_sub_id, our_status)
+            success = await asyncio.to_thread(update_subscription_status, db, stripe_sub_id, our_status)
             if not success:
-                logger.warning(f"Failed to update subscription status for {stripe_sub_id}")
-            return True  # Sempre retorna True para não derrubar webhook
+                logger.warning("Failed to update subscription status for %s", stripe_sub_id)
+            return True, success  # Sempre ack para não derrubar webhook
         elif event_type == "customer.subscription.deleted":
             subscription_obj = event["data"]["object"]
             stripe_sub_id = subscription_obj.get("id")
-            logger.info(f"Subscription deleted: {stripe_sub_id}")
-            success = update_subscription_status(db, stripe_sub_id, "canceled")
+            logger.info("Subscription deleted: %s", stripe_sub_id)
+            success = await asyncio.to_thread(update_subscription_status, db, stripe_sub_id, "canceled")
             if not success:
-                logger.warning(f"Failed to update subscription status for {stripe_sub_id}")
-            return True  # Sempre retorna True para não derrubar webhook
+                logger.warning("Failed to update subscription status for %s", stripe_sub_id)
+            return True, success  # Sempre ack para não derrubar webhook
         else:
-            logger.info(f"Unhandled event type: {event_type}")
+            logger.info("Unhandled event type: %s", event_type)
     except Exception as e:
-        logger.error(f"Error processing event {event_id} ({event_type}): {e}", exc_info=True)
-    return False
+        logger.error("Error processing event %s (%s): %s", event_id, event_type, e, exc_info=True)
+    return False, False
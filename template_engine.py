@@ -3,9 +3,17 @@ Simple Template Engine for LukaMagicBOT
 Renders HTML templates with variable substitution
 """
 import os
+import functools
 from typing import Dict, Any
 
 
+@functools.lru_cache(maxsize=None)
+def _read_template(name: str) -> str:
+    """Read templates/<name>.html once per process (templates ship with the deploy)"""
+    with open(os.path.join("templates", f"{name}.html"), "r", encoding="utf-8") as f:
+        return f.read()
+
+
 def render_template(template_name: str, title: str = "", **context: Any) -> str:
     """
     Render HTML template with context variables
@@ -19,15 +27,9 @@ def render_template(template_name: str, title: str = "", **context: Any) -> str:
         Rendered HTML string
     """
     try:
-        # Load base template
-        base_path = os.path.join("templates", "base.html")
-        with open(base_path, "r", encoding="utf-8") as f:
-            base_template = f.read()
-        
-        # Load specific template
-        template_path = os.path.join("templates", f"{template_name}.html")
-        with open(template_path, "r", encoding="utf-8") as f:
-            content_template = f.read()
+        # Load base and specific templates (cached after the first read)
+        base_template = _read_template("base")
+        content_template = _read_template(template_name)
         
         # Substitute variables in content template
         content = substitute_variables(content_template, context)